@@ -21,27 +21,116 @@
 # SOFTWARE.
 #
 
+import contextlib
+import hashlib
 import os.path
 import re
-import sqlite3
+import threading
 import datetime
+import weakref
+
+from . import markup
+from .columns import Columns, read_columns
+from .duplicates import DuplicateIndex
+from .identity import IdentityMap
+from .links import LinkIndex
+from .pool import ConnectionPool, DataVersion, open_connection
+from .query import NoteQuery
+from .search import SearchIndex
+from .stats import QueryStats, TimedCursor
+from .tagstats import TagStats, tag_stats
+from .tagtree import TagTree
+from .watch import ChangeFeed
 
 __version__ = '0.0.20200629'
 
+# Number of rows pulled from a cursor at a time when streaming results.
+BATCH_SIZE = 500
+
+# The ZSFNOTE columns we need to build a Note without its text. Selecting
+# these rather than * keeps the ZTEXT bodies and ZVECTORCLOCK blobs out of
+# memory when loading lazily.
+NOTE_COLUMNS = [
+    'Z_PK',
+    'ZUNIQUEIDENTIFIER',
+    'ZCREATIONDATE',
+    'ZMODIFICATIONDATE',
+    'ZARCHIVEDDATE',
+    'ZTRASHEDDATE',
+    'ZPERMANENTLYDELETED',
+    'ZPINNED',
+    'ZTITLE',
+]
+
+# Bear's image markup, [image:UUID/name.png]
+IMAGE_RE = re.compile(r'\[image:([^\]]+)\]')
+
+# Where we keep our own files (search index and so on). Never inside Bear's
+# container - we don't write to anything of Bear's.
+CACHE_DIR = '~/.cache/pybear'
+
+# Marker for a Note whose text hasn't been loaded yet.
+_NOT_LOADED = object()
+
+# Core Data timestamps are seconds since 1 Jan 2001, this is how many seconds
+# that is after the Unix epoch (as seen from the local timezone).
+OFFSET = (datetime.datetime(2001, 1, 1, 0, 0, 0)
+    - datetime.datetime.fromtimestamp(0)).total_seconds()
+
 def timestamp_to_datetime(s):
     '''
     Convert a Core Data timestamp to a datetime. They're all a float of seconds
-    since 1 Jan 2001. We calculate the seconds in offset.
+    since 1 Jan 2001.
     '''
     if not s:
         return None
 
-    OFFSET = (datetime.datetime(2001, 1, 1, 0, 0, 0)
-        - datetime.datetime.fromtimestamp(0)).total_seconds()
     return datetime.datetime.fromtimestamp(s + OFFSET)
 
 
+def datetime_to_timestamp(d):
+    '''
+    The reverse of timestamp_to_datetime().
+    '''
+    if d is None:
+        return None
+
+    return d.timestamp() - OFFSET
+
+
+class _Timestamp(object):
+    '''
+    A datetime attribute backed by a raw Core Data timestamp, which is only
+    converted when it's read. Most notes loaded never have most of their
+    dates looked at.
+    '''
+    def __init__(self, raw):
+        self.raw = raw
+
+    def __get__(self, obj, owner=None):
+        if obj is None:
+            return self
+        return timestamp_to_datetime(getattr(obj, self.raw))
+
+    def __set__(self, obj, value):
+        setattr(obj, self.raw, datetime_to_timestamp(value))
+
+
+def iter_batches(cursor, batch_size=BATCH_SIZE):
+    '''
+    Yield the rows of an executed cursor in lists of up to batch_size, so we
+    never hold the whole result set in memory.
+    '''
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            return
+        yield rows
+
+
 class Image(object):
+    __slots__ = ('uri', 'path')
+
     def __init__(self, path, uri):
         self.uri = uri
         self.path = os.path.join(path, uri)
@@ -54,38 +143,42 @@ class Image(object):
 
 
 class Tag(object):
+    __slots__ = ('_bear', 'id', 'title')
+
     def __init__(self, bear, id, title):
         self._bear = bear
         self.id = id
         self.title = title
 
-    def notes(self, include_trashed = False, exact_match = False):
+    def notes(self, include_trashed = False, exact_match = False,
+            prefetch_tags = False, lazy = False):
         """Return all notes with this tag.
 
         If exact_match is True, then ignore notes which have more specific tags.
         E.g. if tag is '#gtd/errands', then notes with more specific tags, such
         as '#gtd/errands/bycar' will not be returned.
+
+        If prefetch_tags is True, the tags of every note are loaded up front in
+        a single query, so Note.tags() doesn't go back to the database once per
+        note. exact_match is answered from the tag tree and a single query
+        either way.
+
+        If lazy is True, the note text isn't selected; see Bear.notes().
         """
-        cursor = self._bear._db.cursor()
+        cursor = self._bear._cursor('Tag.notes')
         cursor.execute('''
-            SELECT * FROM ZSFNOTE
+            SELECT {} FROM ZSFNOTE
             JOIN Z_7TAGS ON
                 ZSFNOTE.Z_PK = Z_7TAGS.Z_7NOTES AND Z_7TAGS.Z_14TAGS=?
-        ''', [self.id])
-
-        for note in cursor.fetchall():
-            n = self._bear._row_to_note(note)
-            if exact_match:
-                def note_has_more_specific_tag (note):
-                    for t in n.tags():
-                        # Does the note have a tag that is more specific?
-                        if t.title.startswith(self.title) and \
-                           len (t.title) > len (self.title):
-                            return True
-                    else:
-                        return False
-                if note_has_more_specific_tag (n):
-                    continue
+        '''.format(self._bear._note_columns(lazy)), [self.id])
+
+        tag_map = self._bear._note_tag_map() if prefetch_tags else None
+        more_specific = self._notes_with_more_specific_tags() \
+            if exact_match else ()
+
+        for n in self._bear._iter_notes(cursor, tag_map, lazy):
+            if n.int_id in more_specific:
+                continue
             if not include_trashed and n.deleted:
                 # FIXME: Recent versions of Bear (e.g. v1.7.7) apparently use a
                 # different flag to indicate notes which have been moved to
@@ -98,45 +191,111 @@ class Tag(object):
                 continue
             yield n
 
+    def _notes_with_more_specific_tags(self):
+        """
+        The Z_PKs of notes carrying any tag below this one, from one query.
+        """
+        below = [t.id for t in self._bear.tag_tree().descendants(self)]
+        if not below:
+            return set()
+
+        cursor = self._bear._cursor('Tag.notes(exact_match)')
+        cursor.execute(
+            'SELECT DISTINCT Z_7NOTES FROM Z_7TAGS WHERE Z_14TAGS IN ({})'
+            .format(', '.join('?' * len(below))), below)
+        return {row[0] for row in cursor.fetchall()}
+
+    def parent(self):
+        return self._bear.tag_tree().parent(self)
+
+    def children(self):
+        return self._bear.tag_tree().children(self)
+
     def __str__(self):
         return "({}) -> {}".format(self.id, self.title)
 
 
 class Note(object):
-    id = None
-    created = None
-    modified = None
-    archived = None
-    trashed = None
-    deleted = False
-    pinned = False
-    title = None
-    text = None
+    # There can be a lot of these, so no per-instance __dict__
+    __slots__ = ('_bear', '_tags', '_batch', '_text', '_markup', 'int_id',
+        'id', '_created', '_modified', '_archived', '_trashed', 'deleted',
+        'pinned', 'title', '__weakref__')
+
+    created = _Timestamp('_created')
+    modified = _Timestamp('_modified')
+    archived = _Timestamp('_archived')
+    trashed = _Timestamp('_trashed')
 
     def __init__(self, bear, int_id, id, created, modified, archived, trashed,
-            deleted, pinned, title, text):
+            deleted, pinned, title, text, tags=None):
+        '''
+        The dates are raw Core Data timestamps, as they are in the database.
+        '''
         self._bear = bear
+        self._tags = tags
         self.int_id = int_id
         self.id = id
-        self.created = timestamp_to_datetime(created)
-        self.modified = timestamp_to_datetime(modified)
-        self.archived = timestamp_to_datetime(archived)
-        self.trashed = timestamp_to_datetime(trashed)
+        self._created = created
+        self._modified = modified
+        self._archived = archived
+        self._trashed = trashed
         self.deleted = deleted
         self.pinned = pinned
         self.title = title
-        self.text = text
+        self._text = text
+        self._batch = None
+        self._markup = None
+
+    @property
+    def text(self):
+        '''
+        The note body. Notes loaded lazily fetch it on first access, together
+        with the text of the other notes that came from the same batch.
+        '''
+        if self._text is _NOT_LOADED:
+            self._bear._load_text(self._batch or [self])
+        return self._text
+
+    @text.setter
+    def text(self, value):
+        self._text = value
+        self._markup = None
+
+    def markup(self):
+        '''
+        The images, files, inline tags, todos, headings and links in the text,
+        as a markup.NoteSummary. The text is parsed once and the result kept
+        until the note's modification date changes.
+        '''
+        if self._markup is None or self._markup[0] != self._modified:
+            self._markup = (self._modified, markup.parse(self.text))
+        return self._markup[1]
 
     def tags(self):
-        cursor = self._bear._db.cursor()
+        if self._tags is not None:
+            yield from self._tags
+            return
+
+        cursor = self._bear._cursor('Note.tags')
         cursor.execute('''
             SELECT * FROM ZSFNOTETAG
             JOIN Z_7TAGS ON
                 Z_7TAGS.Z_7NOTES = ? AND Z_7TAGS.Z_14TAGS = ZSFNOTETAG.Z_PK
         ''', [self.int_id])
 
-        for tag in cursor.fetchall():
-            yield self._bear._row_to_tag(tag)
+        identity = self._bear._identity
+        if identity is not None and identity.holds(self):
+            # Keep them, as prefetch_tags does. The identity map drops the
+            # note when the database changes, and its tags with it. Notes it
+            # doesn't hold (from notes(), say) could be kept around by the
+            # caller for any length of time, so they get no copy to go stale.
+            self._tags = [self._bear._row_to_tag(tag) for tag in cursor.fetchall()]
+            yield from self._tags
+            return
+
+        for rows in iter_batches(cursor):
+            for tag in rows:
+                yield self._bear._row_to_tag(tag)
 
     def specific_tags(self):
         """
@@ -149,46 +308,352 @@ class Note(object):
         return all these higher-order tags.
         """
 
-        all_tags = sorted (self.tags(), \
-                            key=lambda t: len(t.title))
-        specific_tags = []
-        for tag in all_tags:
-            if tag.title in [ t.title[:len(tag.title)] \
-                            for t in all_tags \
-                            if len(t.title) > len (tag.title) ]:
-                continue
-            else:
-                specific_tags.append (tag)
-        return specific_tags
+        return self._bear.tag_tree().specific_tags(self.tags())
 
     def images(self):
-        for uri in re.findall(r'\[image:([^\]]+)\]', self.text):
-            yield Image(
-                os.path.join(os.path.dirname(self._bear._path),
-                    "Local Files/Note Images"),
-                uri)
+        for uri in self.markup().images:
+            yield self._bear.image(uri)
+
+    def outlinks(self):
+        '''
+        The [[wiki links]] in this note, as links.WikiLink tuples. The id and
+        title of the note each one leads to are None if there isn't one.
+        '''
+        return self._bear.link_index().outlinks(self.id)
+
+    def backlinks(self):
+        '''
+        The notes that link to this one, as links.WikiLink tuples, one per
+        linking note. Answered from the link index, not by reading notes.
+        '''
+        return self._bear.link_index().backlinks(self.id)
+
+    def todos(self):
+        '''
+        The note's todos, as markup.Todo tuples of (text, checked, line).
+        '''
+        return list(self.markup().todos)
+
+    def links(self):
+        '''
+        The note's links, as markup.Link tuples of (kind, target, text): kind
+        is 'wiki' for [[Note Title]] links, 'markdown' or 'url'.
+        '''
+        return list(self.markup().links)
 
     def __str__(self):
         return "({}) {} ({} chars)".format(self.id, self.title, len(self.text))
 
 
 class Bear(object):
-    def __init__(self, path=None, *, connect=True):
+    def __init__(self, path=None, *, connect=True, cache_dir=None,
+            identity_map=None, **kwds):
+        '''
+        identity_map=True (or an IdentityMap, to set its limits) keeps the
+        tags and notes looked up, and hands back the same objects until the
+        database changes; see bear.identity.
+
+        Any extra keyword arguments are passed on to connect().
+        '''
         if path:
             self._path = path
         else:
             self._path = os.path.expanduser(
                 '~//Library/Containers/net.shinyfrog.bear/Data/Library'
                 '/Application Support/net.shinyfrog.bear/database.sqlite')
+        self._cache_dir = os.path.expanduser(cache_dir or CACHE_DIR)
+        self._tag_tree = None
+        self._tag_stats = None
+        self._search_index = None
+        self._link_index = None
+        self._duplicate_index = None
+        self._links_stale = True
+        self._conn = None
+        self._pool = None
+        self._local = threading.local()
+        self._stats = None
+        self._identity = IdentityMap() if identity_map is True \
+            else identity_map or None
+        if self._identity is not None:
+            self._identity.open(self._path)
+        # Without an identity map (which has its own), this tells us when the
+        # tag tree and the like need rebuilding
+        self._data_version = DataVersion(self._path)
         if connect:
-            self.connect()
+            self.connect(**kwds)
+
+    def tag_tree(self, refresh=False):
+        '''
+        The TagTree index of all tags. It's built on first use and cached on
+        this Bear until the database changes; refresh=True rebuilds it anyway.
+        '''
+        self._fresh()
+        if refresh or self._tag_tree is None:
+            self._tag_tree = TagTree(self.tags())
+        return self._tag_tree
+
+    def tag_stats(self, refresh=False):
+        '''
+        Note counts for every tag, as a tree of TagStats (one per top level
+        tag, each with its children): notes with the tag or one below it,
+        notes with just the tag, trashed and archived notes, and when the
+        latest of them was modified. It's one query, however many tags there
+        are, and like tag_tree() the result is kept until the database
+        changes; refresh=True runs it again anyway.
+        '''
+        self._fresh()
+        if refresh or self._tag_stats is None:
+            self._tag_stats = tag_stats(self)
+        return self._tag_stats
+
+    def _invalidate(self):
+        '''
+        Forget anything cached from the database, it's changed.
+        '''
+        self._tag_tree = None
+        self._tag_stats = None
+        self._links_stale = True
+        if self._identity is not None:
+            self._identity.clear()
+
+    def _fresh(self):
+        '''
+        Forget everything cached if the database has changed.
+        '''
+        changed = self._identity.changed() if self._identity is not None \
+            else self._data_version.changed()
+        if changed:
+            self._invalidate()
+
+    def sidecar_path(self, filename):
+        '''
+        Path of one of our own files for this database, under the cache dir.
+        Each Bear database gets its own directory so they don't collide.
+        '''
+        key = hashlib.sha1(os.path.abspath(self._path).encode('utf8'))
+        path = os.path.join(self._cache_dir, key.hexdigest()[:16])
+        os.makedirs(path, exist_ok=True)
+        return os.path.join(path, filename)
+
+    def search_index(self, path=None):
+        '''
+        The SearchIndex for this database, stored at path (by default a
+        sidecar file in the cache dir). Call refresh() on it before searching.
+        '''
+        if self._search_index is None:
+            self._search_index = SearchIndex(
+                self, path or self.sidecar_path('search.sqlite'))
+        return self._search_index
+
+    def search(self, query, limit=20, plain=False):
+        '''
+        Full text search of note titles and text. The index is brought up to
+        date first, which only touches notes modified since the last search.
+        query is in FTS5 syntax unless plain is True; see SearchIndex.search().
 
-    def connect(self, **kwds):
-        self._db = sqlite3.connect(self._path, **kwds)
-        self._db.row_factory = sqlite3.Row
+        Returns a list of SearchResult, best match first, each with a snippet
+        of the matching text.
+        '''
+        index = self.search_index()
+        index.refresh()
+        return index.search(query, limit, plain)
+
+    def link_index(self, path=None, refresh=False):
+        '''
+        The LinkIndex of [[wiki links]] between notes, stored at path (by
+        default a sidecar file in the cache dir). It's brought up to date on
+        first use, and again once the database has changed; pass refresh=True
+        to update it now.
+        '''
+        self._fresh()
+        if self._link_index is None:
+            self._link_index = LinkIndex(
+                self, path or self.sidecar_path('links.sqlite'))
+        if refresh or self._links_stale:
+            self._link_index.refresh()
+            self._links_stale = False
+        return self._link_index
+
+    def duplicate_index(self, path=None):
+        '''
+        The DuplicateIndex of note signatures for this database, stored at
+        path (by default a sidecar file in the cache dir). Call refresh() on
+        it before looking for duplicates.
+        '''
+        if self._duplicate_index is None:
+            self._duplicate_index = DuplicateIndex(
+                self, path or self.sidecar_path('duplicates.sqlite'))
+        return self._duplicate_index
+
+    def find_duplicates(self, threshold=0.8):
+        '''
+        Groups of notes that are nearly the same, as DuplicateClusters,
+        biggest first. threshold is how much of their text (as a proportion
+        of three word runs) two notes must share. Only notes modified since
+        the last call are read.
+        '''
+        index = self.duplicate_index()
+        index.refresh()
+        return index.clusters(threshold)
+
+    def change_feed(self, since=None):
+        '''
+        A ChangeFeed for this database, see watch().
+        '''
+        return ChangeFeed(self, since)
+
+    def watch(self, interval=1.0, since=None):
+        '''
+        Generator of ChangeEvents (created, modified, trashed and deleted
+        notes) as they happen, checking every interval seconds. Checking is
+        cheap when nothing has changed, and when something has only the
+        affected notes are read. It never finishes, so break out when you're
+        done.
+        '''
+        feed = self.change_feed(since)
+        try:
+            while True:
+                yield from feed.wait(interval)
+        finally:
+            feed.close()
+
+    def connect(self, read_only=False, immutable=False, pool_size=None,
+            pragmas=None, instrument=False, slow_query=0.5, **kwds):
+        '''
+        Open the database. Bear has it open too, so read_only=True is the
+        safest way to go: it uses a mode=ro URI, sets query_only, and tunes
+        mmap_size and cache_size for reading. immutable=True goes further and
+        turns off locking, which is only safe for a copy of the database that
+        nothing is writing to. pragmas is a dict of extra PRAGMAs to set.
+
+        With pool_size, connections come from a ConnectionPool and each
+        thread gets its own. A thread takes one the first time it needs it and
+        keeps it until release(); wrapping each unit of work (a web request,
+        say) in `with bear.connection():` hands it back at the end.
+
+        instrument=True keeps count of the queries run, see stats(). Queries
+        taking longer than slow_query seconds are logged.
+        '''
+        if instrument:
+            self._stats = QueryStats(slow_query)
+
+        if pool_size:
+            self._pool = ConnectionPool(self._path, size=pool_size,
+                read_only=read_only, immutable=immutable, pragmas=pragmas,
+                on_connect=self._connected, **kwds)
+            self._conn = None
+        else:
+            self._pool = None
+            self._conn = open_connection(self._path, read_only, immutable,
+                pragmas, **kwds)
+            self._connected(self._conn)
+
+    def _connected(self, db):
+        if self._stats is not None:
+            db.set_trace_callback(self._stats.trace)
+
+    def _cursor(self, site):
+        '''
+        A cursor on the current connection. site names the caller, for the
+        stats when instrumented.
+        '''
+        cursor = self._db.cursor()
+        if self._stats is None:
+            return cursor
+        return TimedCursor(cursor, site, self._stats)
+
+    def stats(self):
+        '''
+        A snapshot of the query stats, if connected with instrument=True:
+        queries, rows and time in total and for each call site (e.g.
+        'Note.tags'), with a latency histogram, the number of statements run
+        of each kind and the slowest queries. None if not instrumented.
+        '''
+        if self._stats is None:
+            return None
+        return self._stats.snapshot()
+
+    def reset_stats(self):
+        if self._stats is not None:
+            self._stats.reset()
+
+    @property
+    def _db(self):
+        if self._pool is None:
+            return self._conn
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = self._local.db = self._pool.acquire()
+        return db
+
+    @contextlib.contextmanager
+    def connection(self, db=None):
+        '''
+        Check out a connection for the current thread for the duration of the
+        with block. Nested blocks share the outer block's connection.
 
-    def notes(self):
+        db, if given, is a connection of the caller's own (from
+        ConnectionPool.open(), say) to use in the block instead.
+        '''
+        if db is not None and self._pool is not None:
+            outer = getattr(self._local, 'db', None)
+            self._local.db = db
+            try:
+                yield db
+            finally:
+                self._local.db = outer
+            return
+
+        if self._pool is None or getattr(self._local, 'db', None) is not None:
+            yield self._db
+            return
+
+        db = self._local.db = self._pool.acquire()
+        try:
+            yield db
+        finally:
+            self._local.db = None
+            self._pool.release(db)
+
+    def release(self):
+        '''
+        Hand the current thread's pooled connection back to the pool.
+        '''
+        db = getattr(self._local, 'db', None)
+        if self._pool is not None and db is not None:
+            self._local.db = None
+            self._pool.release(db)
+
+    def close(self):
+        # The sidecar indexes have connections of their own
+        for name in ('_search_index', '_link_index', '_duplicate_index'):
+            index = getattr(self, name)
+            if index is not None:
+                index.close()
+                setattr(self, name, None)
+        if self._identity is not None:
+            self._identity.close()
+        self._data_version.close()
+        if self._pool is not None:
+            self.release()
+            self._pool.close()
+        elif self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def notes(self, prefetch_tags=False, lazy=False):
         '''
+        If prefetch_tags is True, the note to tag mapping is loaded in a single
+        query and each note carries its tags, so Note.tags() doesn't need to
+        query the database again.
+
+        If lazy is True, only the metadata columns are selected and Note.text
+        is loaded on first access, a batch of notes at a time. Use this when
+        you're only interested in titles, dates and the like.
+
+        Rows are streamed from the database in batches of BATCH_SIZE either
+        way, so the first note is available straight away.
+
         .. code-block:: sql
 
             CREATE TABLE ZSFNOTE (
@@ -223,13 +688,91 @@ class Bear(object):
             );
         '''
 
-        cursor = self._db.cursor()
-        cursor.execute("SELECT * FROM ZSFNOTE")
+        cursor = self._cursor('Bear.notes')
+        cursor.execute("SELECT {} FROM ZSFNOTE".format(self._note_columns(lazy)))
 
-        for note in cursor.fetchall():
-            yield self._row_to_note(note)
+        tag_map = self._note_tag_map() if prefetch_tags else None
 
-    def _row_to_note(self, row):
+        yield from self._iter_notes(cursor, tag_map, lazy)
+
+    def to_columns(self, numpy=False):
+        '''
+        Every note as a Columns: ids, titles, dates, flags and lengths, each
+        as one flat array, with a CSR index of their tags. It takes three
+        queries and no Note objects, and can be saved as a memory mapped
+        snapshot with Columns.save(). numpy=True gives numpy arrays, if it's
+        installed.
+        '''
+        return read_columns(self, numpy)
+
+    def query(self):
+        '''
+        A NoteQuery for filtering notes by tags, dates and flags in the
+        database rather than in Python.
+        '''
+        return NoteQuery(self)
+
+    def _note_columns(self, lazy):
+        if not lazy:
+            return 'ZSFNOTE.*'
+        return ', '.join('ZSFNOTE.' + c for c in NOTE_COLUMNS)
+
+    def _iter_notes(self, cursor, tag_map=None, lazy=False):
+        for rows in iter_batches(cursor):
+            notes = [self._row_to_note(row, tag_map, lazy) for row in rows]
+            if lazy:
+                # Weakly, so keeping one note doesn't keep the whole batch
+                batch = weakref.WeakSet(notes)
+                for n in notes:
+                    n._batch = batch
+            yield from notes
+
+    def _load_text(self, notes):
+        '''
+        Fill in the text of the given lazily loaded notes with one query.
+        '''
+        notes = list(notes)
+        # Their text is about to be loaded, the batch has done its job
+        for n in notes:
+            n._batch = None
+        pending = {n.int_id: n for n in notes if n._text is _NOT_LOADED}
+        if not pending:
+            return
+
+        cursor = self._cursor('Bear.load_text')
+        cursor.execute(
+            'SELECT Z_PK, ZTEXT FROM ZSFNOTE WHERE Z_PK IN ({})'.format(
+                ', '.join('?' * len(pending))),
+            list(pending))
+        for row in cursor.fetchall():
+            pending.pop(row['Z_PK'])._text = row['ZTEXT']
+
+        # Anything left has vanished from the database since we listed it.
+        for n in pending.values():
+            n._text = None
+
+    def _note_tag_map(self):
+        '''
+        Load the tags of every note in one go. Returns a dict mapping the note's
+        Z_PK to a list of Tag objects; each Tag is only built once and shared
+        between the notes that carry it.
+        '''
+        cursor = self._cursor('Bear.note_tag_map')
+        cursor.execute('''
+            SELECT Z_7TAGS.Z_7NOTES AS NOTE_PK, ZSFNOTETAG.* FROM Z_7TAGS
+            JOIN ZSFNOTETAG ON Z_7TAGS.Z_14TAGS = ZSFNOTETAG.Z_PK
+        ''')
+
+        tags = {}
+        tag_map = {}
+        for row in cursor.fetchall():
+            tag = tags.get(row['Z_PK'])
+            if tag is None:
+                tag = tags[row['Z_PK']] = self._row_to_tag(row)
+            tag_map.setdefault(row['NOTE_PK'], []).append(tag)
+        return tag_map
+
+    def _row_to_note(self, row, tag_map=None, lazy=False):
         return Note(
             bear = self,
             int_id = row['Z_PK'],
@@ -241,17 +784,57 @@ class Bear(object):
             deleted = row['ZPERMANENTLYDELETED'] != 0,
             pinned = row['ZPINNED'] != 0,
             title = row['ZTITLE'],
-            text = row['ZTEXT']
+            text = _NOT_LOADED if lazy else row['ZTEXT'],
+            tags = tag_map.get(row['Z_PK'], []) if tag_map is not None else None
         )
 
     def get_note(self, id):
-        cursor = self._db.cursor()
+        if self._identity is not None:
+            self._fresh()
+            note = self._identity.note(id)
+            if note is not None:
+                return note
+
+        cursor = self._cursor('Bear.get_note')
         cursor.execute(
-            'SELECT * FROM ZFSNOTE WHERE ZUNIQUEIDENTIFIER = ?', [id])
+            'SELECT * FROM ZSFNOTE WHERE ZUNIQUEIDENTIFIER = ?', [id])
         row = cursor.fetchone()
         if not row:
             return None
-        return self._row_to_note(row)
+        return self._cached_note(self._row_to_note(row))
+
+    def _cached_note(self, note):
+        if self._identity is not None:
+            return self._identity.add_note(note)
+        return note
+
+    def get_notes(self, ids):
+        '''
+        Look up several notes by id, a batch at a time rather than a query per
+        note. Returns a list in the same order as ids, with None for any that
+        don't exist.
+        '''
+        ids = list(ids)
+        found = {}
+        missing = ids
+        if self._identity is not None:
+            self._fresh()
+            for id in ids:
+                note = self._identity.note(id)
+                if note is not None:
+                    found[id] = note
+            missing = [id for id in ids if id not in found]
+
+        cursor = self._cursor('Bear.get_notes')
+        for i in range(0, len(missing), BATCH_SIZE):
+            batch = missing[i:i + BATCH_SIZE]
+            cursor.execute(
+                'SELECT * FROM ZSFNOTE WHERE ZUNIQUEIDENTIFIER IN ({})'.format(
+                    ', '.join('?' * len(batch))), batch)
+            for row in cursor.fetchall():
+                found[row['ZUNIQUEIDENTIFIER']] = self._cached_note(
+                    self._row_to_note(row))
+        return [found.get(id) for id in ids]
 
     def tags(self):
         '''
@@ -266,21 +849,47 @@ class Bear(object):
             );
         '''
 
-        cursor = self._db.cursor()
-        cursor.execute("SELECT * FROM ZSFNOTETAG")
+        if self._identity is not None:
+            self._fresh()
+            tags = self._identity.all_tags()
+            if tags is None:
+                tags = self._identity.set_all_tags(self._query_tags())
+            yield from tags
+            return
+
+        yield from self._query_tags()
 
-        for tag in cursor.fetchall():
-            yield self._row_to_tag(tag)
+    def _query_tags(self):
+        cursor = self._cursor('Bear.tags')
+        cursor.execute("SELECT Z_PK, ZTITLE FROM ZSFNOTETAG")
+
+        for rows in iter_batches(cursor):
+            for tag in rows:
+                yield self._row_to_tag(tag)
 
     def _row_to_tag(self, row):
-        return Tag(
+        tag = Tag(
             bear = self,
             id = row['Z_PK'],
             title = row['ZTITLE']
         )
+        if self._identity is not None:
+            return self._identity.tag(tag)
+        return tag
+
+    def image(self, uri):
+        return Image(
+            os.path.join(os.path.dirname(self._path), "Local Files/Note Images"),
+            uri)
 
     def tag_by_title(self, title):
-        cursor = self._db.cursor()
+        if self._identity is not None:
+            self._fresh()
+            tag = self._identity.tag_by_title(title)
+            if tag is not None or self._identity.has_all_tags():
+                return tag
+
+        cursor = self._cursor('Bear.tag_by_title')
         cursor.execute('SELECT * FROM ZSFNOTETAG WHERE ZTITLE = ?', [title])
 
         tag = cursor.fetchone()
@@ -0,0 +1,299 @@
+#
+# Copyright (c) 2020  Richard Clark
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+"""
+An asyncio flavour of the API. The database work still happens in ordinary
+threads - sqlite3 has no async interface - but it's pushed out to an
+executor so the event loop never waits on it.
+
+    async with AsyncBear(pool_size = 8) as b:
+        async for note in b.notes(lazy = True):
+            print(note.title)
+        note = await b.get_note('...')
+        tags = await note.tags()
+"""
+import asyncio
+import concurrent.futures
+import functools
+import itertools
+
+from . import BATCH_SIZE, Bear, _NOT_LOADED
+
+
+class AsyncTag(object):
+    """
+    Wraps a Tag. Plain attributes (id, title) are passed straight through.
+    """
+    def __init__(self, abear, tag):
+        self._abear = abear
+        self._tag = tag
+
+    def __getattr__(self, name):
+        return getattr(self._tag, name)
+
+    def notes(self, include_trashed = False, exact_match = False,
+            prefetch_tags = False, lazy = False, batch_size = BATCH_SIZE):
+        """
+        Async iterator over the notes with this tag, see Tag.notes().
+        """
+        return self._abear._stream(functools.partial(self._tag.notes,
+            include_trashed = include_trashed, exact_match = exact_match,
+            prefetch_tags = prefetch_tags, lazy = lazy),
+            self._abear._wrap_note, batch_size)
+
+    async def parent(self):
+        tag = await self._abear._run(self._tag.parent)
+        return self._abear._wrap_tag(tag)
+
+    async def children(self):
+        tags = await self._abear._run(self._tag.children)
+        return [self._abear._wrap_tag(t) for t in tags]
+
+    def __str__(self):
+        return str(self._tag)
+
+
+class AsyncNote(object):
+    """
+    Wraps a Note. Plain attributes (title, created, ...) are passed straight
+    through, anything that might touch the database is a coroutine.
+    """
+    def __init__(self, abear, note):
+        self._abear = abear
+        self._note = note
+
+    def __getattr__(self, name):
+        return getattr(self._note, name)
+
+    @property
+    def text(self):
+        if self._note._text is _NOT_LOADED:
+            # Not AttributeError, that would fall back to __getattr__ and
+            # load it synchronously
+            raise RuntimeError(
+                'Text of lazily loaded note not fetched yet, '
+                'use "await note.load_text()"')
+        return self._note._text
+
+    async def load_text(self):
+        if self._note._text is _NOT_LOADED:
+            await self._abear._run(lambda: self._note.text)
+        return self._note._text
+
+    async def tags(self):
+        tags = await self._abear._run(lambda: list(self._note.tags()))
+        return [self._abear._wrap_tag(t) for t in tags]
+
+    async def specific_tags(self):
+        tags = await self._abear._run(self._note.specific_tags)
+        return [self._abear._wrap_tag(t) for t in tags]
+
+    # These only need the text, no database access. Checking self.text first
+    # raises if it hasn't been loaded yet.
+
+    def images(self):
+        return self._note.images() if self.text is not None else iter(())
+
+    def markup(self):
+        self.text
+        return self._note.markup()
+
+    def todos(self):
+        self.text
+        return self._note.todos()
+
+    def links(self):
+        self.text
+        return self._note.links()
+
+    def __str__(self):
+        return str(self._note)
+
+
+class AsyncBear(object):
+    """
+    Mirrors Bear. Opens the database read only by default, with a pool of
+    pool_size connections and the same number of executor threads; any other
+    keyword arguments go to Bear.connect().
+
+    Each iteration (notes(), tags(), Tag.notes()) has a connection of its own,
+    apart from the pool, until it's finished or abandoned, and fetches its
+    results batch_size at a time in executor calls, so awaiting other calls
+    inside an `async for` is fine. At most max_streams iterations (pool_size
+    by default) run at once, and their connections are kept for the next
+    ones; any more wait, without holding a thread, for one to finish. An
+    iteration nested inside another counts too, so with nesting make
+    max_streams bigger than the number of outer loops running at once.
+    """
+    def __init__(self, path = None, *, pool_size = 4, max_streams = None,
+            read_only = True, cache_dir = None, **kwds):
+        self._bear = Bear(path, cache_dir = cache_dir, read_only = read_only,
+            pool_size = pool_size, **kwds)
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            pool_size, thread_name_prefix = 'pybear')
+        self._max_streams = max_streams or pool_size
+        # Made on first use, so it belongs to the loop that uses it
+        self._streams = None
+        self._stream_dbs = []
+
+    @property
+    def bear(self):
+        """
+        The underlying (blocking) Bear.
+        """
+        return self._bear
+
+    def _call(self, fn, args, kwds):
+        with self._bear.connection():
+            return fn(*args, **kwds)
+
+    def _run(self, fn, *args, **kwds):
+        loop = asyncio.get_running_loop()
+        return loop.run_in_executor(self._executor,
+            functools.partial(self._call, fn, args, kwds))
+
+    def _wrap_note(self, note):
+        return AsyncNote(self, note) if note is not None else None
+
+    def _wrap_tag(self, tag):
+        return AsyncTag(self, tag) if tag is not None else None
+
+    async def _stream(self, fn, wrap, batch_size):
+        """
+        Yield what the generator returned by fn() produces, wrapped. Each
+        batch is fetched with an executor call of its own, so no thread is
+        tied up while the caller works through a batch - and perhaps awaits
+        other calls, which need those threads. The next batch is fetched
+        while the caller works through this one.
+
+        The stream does need the same connection throughout, so it has one
+        of its own rather than holding one of the pool's, see the class
+        docstring.
+        """
+        loop = asyncio.get_running_loop()
+        if self._streams is None:
+            self._streams = asyncio.Semaphore(self._max_streams)
+        async with self._streams:
+            pool = self._bear._pool
+            if pool is None:
+                db = None
+            elif self._stream_dbs:
+                db = self._stream_dbs.pop()
+            else:
+                db = await loop.run_in_executor(self._executor, pool.open)
+            items = None
+
+            def fetch():
+                nonlocal items
+                with self._bear.connection(db):
+                    if items is None:
+                        items = fn()
+                    return list(itertools.islice(items, batch_size))
+
+            def finish():
+                with self._bear.connection(db):
+                    if items is not None:
+                        items.close()
+                if db is not None and db.in_transaction:
+                    db.rollback()
+
+            pending = loop.run_in_executor(self._executor, fetch)
+            try:
+                while True:
+                    batch = await pending
+                    if not batch:
+                        break
+                    pending = loop.run_in_executor(self._executor, fetch)
+                    for item in batch:
+                        yield wrap(item)
+            finally:
+                # The generator can't be closed while a fetch is running it
+                if not pending.done():
+                    try:
+                        await pending
+                    except Exception:
+                        pass
+                try:
+                    await loop.run_in_executor(self._executor, finish)
+                finally:
+                    # Kept for the next stream
+                    if db is not None:
+                        self._stream_dbs.append(db)
+
+    def notes(self, prefetch_tags = False, lazy = False,
+            batch_size = BATCH_SIZE):
+        """
+        Async iterator over all notes, see Bear.notes().
+        """
+        return self._stream(functools.partial(self._bear.notes,
+            prefetch_tags = prefetch_tags, lazy = lazy),
+            self._wrap_note, batch_size)
+
+    def tags(self, batch_size = BATCH_SIZE):
+        return self._stream(self._bear.tags, self._wrap_tag, batch_size)
+
+    async def get_note(self, id):
+        return self._wrap_note(await self._run(self._bear.get_note, id))
+
+    async def get_notes(self, ids):
+        """
+        Look up several notes by id at once, in a single query. Returns a
+        list in the same order, with None for notes that don't exist.
+        """
+        notes = await self._run(self._bear.get_notes, ids)
+        return [self._wrap_note(n) for n in notes]
+
+    async def tag_by_title(self, title):
+        return self._wrap_tag(await self._run(self._bear.tag_by_title, title))
+
+    async def tag_tree(self, refresh = False):
+        return await self._run(self._bear.tag_tree, refresh)
+
+    async def search(self, query, limit = 20, plain = False):
+        return await self._run(self._bear.search, query, limit, plain)
+
+    async def watch(self, interval = 1.0, since = None):
+        """
+        Async iterator of ChangeEvents, see Bear.watch().
+        """
+        feed = await self._run(self._bear.change_feed, since)
+        try:
+            while True:
+                for event in await self._run(feed.poll):
+                    event.note = self._wrap_note(event.note)
+                    yield event
+                await asyncio.sleep(interval)
+        finally:
+            feed.close()
+
+    async def close(self):
+        await asyncio.get_running_loop().run_in_executor(
+            None, self._executor.shutdown)
+        while self._stream_dbs:
+            self._stream_dbs.pop().close()
+        self._bear.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
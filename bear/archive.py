@@ -0,0 +1,184 @@
+#
+# Copyright (c) 2020  Richard Clark
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+"""
+Exporting straight into a zip or tar archive, rather than to a directory
+which then gets archived. Notes go into the archive as they're rendered and
+images are streamed in from Bear's image directory, so nothing is staged on
+disk and memory use doesn't grow with the size of the library.
+
+.tar.zst needs the zstandard package; everything else is in the standard
+library.
+"""
+import io
+import os
+import tarfile
+import time
+import zipfile
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+TAR_MODES = {
+    '.tar': 'w|',
+    '.tar.gz': 'w|gz',
+    '.tgz': 'w|gz',
+    '.tar.bz2': 'w|bz2',
+    '.tar.xz': 'w|xz',
+}
+
+FORMATS = sorted(list(TAR_MODES) + ['.tar.zst', '.zip'])
+
+
+class ArchiveError(Exception):
+    pass
+
+
+class TarSink(object):
+    def __init__(self, path, mode, compressor = None):
+        self._file = open(path, 'wb')
+        self._writer = None
+        fileobj = self._file
+        if compressor is not None:
+            fileobj = self._writer = compressor.stream_writer(self._file)
+        self._tar = tarfile.open(fileobj = fileobj, mode = mode)
+
+    def add_bytes(self, name, data, mtime = None):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = mtime if mtime is not None else time.time()
+        info.mode = 0o644
+        self._tar.addfile(info, io.BytesIO(data))
+
+    def add_file(self, name, path):
+        info = self._tar.gettarinfo(path, arcname = name)
+        info.uid = info.gid = 0
+        info.uname = info.gname = ''
+        with open(path, 'rb') as f:
+            self._tar.addfile(info, f)
+
+    def close(self):
+        self._tar.close()
+        if self._writer is not None:
+            self._writer.close()
+        self._file.close()
+
+
+class ZipSink(object):
+    def __init__(self, path):
+        self._zip = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED)
+
+    def add_bytes(self, name, data, mtime = None):
+        info = zipfile.ZipInfo(name, time.localtime(
+            mtime if mtime is not None else time.time())[:6])
+        info.compress_type = zipfile.ZIP_DEFLATED
+        info.external_attr = 0o644 << 16
+        self._zip.writestr(info, data)
+
+    def add_file(self, name, path):
+        # Images are already compressed, squeezing them again is wasted time
+        self._zip.write(path, name, zipfile.ZIP_STORED)
+
+    def close(self):
+        self._zip.close()
+
+
+def open_sink(path):
+    """
+    A sink for the archive at path, the format chosen by its extension.
+    """
+    lower = path.lower()
+    if lower.endswith('.zip'):
+        return ZipSink(path)
+    if lower.endswith('.tar.zst'):
+        if zstandard is None:
+            raise ArchiveError('.tar.zst archives need the zstandard package '
+                               '(pip install zstandard)')
+        return TarSink(path, 'w|', zstandard.ZstdCompressor())
+    for ext, mode in TAR_MODES.items():
+        if lower.endswith(ext):
+            return TarSink(path, mode)
+    raise ArchiveError("Don't know how to make an archive called {}, "
+                       "try one of {}".format(path, ', '.join(FORMATS)))
+
+
+class ArchiveExport(object):
+    """
+    Stands in for ExportManifest when exporting to an archive: same
+    interface, but every note is written (there's no previous export to
+    compare with) and images are added to the archive, each once.
+    """
+    def __init__(self, path):
+        self._path = path
+        self._sink = open_sink(path)
+        self._images = set()
+        self._names = set()
+        self.report = {
+            'written': 0,
+            'images': 0,
+            'bytes': 0,
+        }
+
+    def check_note(self, note, filename, depends = None):
+        return True
+
+    def export_note(self, note, filename, render, depends = None):
+        self.write_note(note, filename, render())
+        return True
+
+    def write_note(self, note, filename, content, depends = None):
+        # Two notes with the same title would otherwise both go in, and most
+        # tools only extract the last one
+        if filename in self._names:
+            return
+        self._names.add(filename)
+
+        mtime = note.modified.timestamp() if note.modified else None
+        self.add_bytes(filename, content.encode('utf8'), mtime)
+        self.report['written'] += 1
+
+        for image in note.images():
+            self.copy_image(image)
+
+    def add_bytes(self, name, data, mtime = None):
+        self._sink.add_bytes(name, data, mtime)
+        self.report['bytes'] += len(data)
+
+    def copy_image(self, image):
+        if image.uri in self._images or not image.exists():
+            return
+        self._images.add(image.uri)
+        self._sink.add_file(image.uri, image.path)
+        self.report['images'] += 1
+        self.report['bytes'] += os.path.getsize(image.path)
+
+    def finish(self):
+        self._sink.close()
+        return self.report
+
+    def summary(self):
+        return '{} notes and {} images written to {} ({} bytes before compression)'.format(
+            self.report['written'], self.report['images'], self._path,
+            self.report['bytes'])
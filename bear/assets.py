@@ -0,0 +1,159 @@
+#
+# Copyright (c) 2020  Richard Clark
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+"""
+Copying images out of Bear. Libraries with lots of screenshots can mean
+gigabytes of images, so we copy each one once, several at a time, and let
+the filesystem do the work where it can: a reflink (copy on write clone)
+costs no extra disk space at all, and copy_file_range() keeps the data in
+the kernel. Hard links are cheapest of all but make the export share files
+with Bear, so they're only used when asked for.
+"""
+import concurrent.futures
+import ctypes
+import ctypes.util
+import errno
+import os
+import shutil
+import sys
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+# From linux/fs.h
+FICLONE = 0x40049409
+
+# Errors meaning "this filesystem (pair) can't do that", rather than that
+# something is actually wrong
+UNSUPPORTED = {errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EINVAL,
+               errno.ENOSYS, errno.ENOTTY, errno.EPERM, errno.EMLINK}
+
+_libc = None
+
+
+def _clonefile(source, target):
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno = True)
+    if _libc.clonefile(os.fsencode(source), os.fsencode(target), 0) != 0:
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e), target)
+
+
+def reflink(source, target):
+    if sys.platform == 'darwin':
+        _clonefile(source, target)
+        return
+    if fcntl is None or not sys.platform.startswith('linux'):
+        raise OSError(errno.EOPNOTSUPP, 'reflinks not supported here', target)
+    with open(source, 'rb') as src, open(target, 'wb') as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+
+
+def copy_range(source, target):
+    if not hasattr(os, 'copy_file_range'):
+        raise OSError(errno.ENOSYS, 'copy_file_range not available', target)
+    with open(source, 'rb') as src, open(target, 'wb') as dst:
+        remaining = os.fstat(src.fileno()).st_size
+        while remaining > 0:
+            copied = os.copy_file_range(src.fileno(), dst.fileno(), remaining)
+            if copied == 0:
+                # Some filesystems give up early rather than fail; don't let a
+                # truncated copy pass for a whole one
+                raise OSError(errno.ENOSYS,
+                              'copy_file_range stopped short', target)
+            remaining -= copied
+
+
+def plain_copy(source, target):
+    # shutil already uses sendfile() on Linux and fcopyfile() on macOS
+    shutil.copyfile(source, target)
+
+
+class AssetCopier(object):
+    """
+    Copies files on a pool of threads, each target at most once. submit() a
+    copy and call wait() at the end; report holds how many files were copied
+    by each method.
+    """
+    def __init__(self, jobs = 8, hardlink = False):
+        self._pool = concurrent.futures.ThreadPoolExecutor(
+            jobs, thread_name_prefix = 'pybear-assets')
+        self._futures = {}
+        self._lock = threading.Lock()
+        # (method, source device, target device) combinations that failed
+        # as unsupported, so we don't try them again for every file
+        self._unsupported = set()
+        self._methods = [('reflink', reflink), ('copy_file_range', copy_range)]
+        if hardlink:
+            self._methods.insert(0, ('hardlink', os.link))
+        self.report = {}
+
+    def submit(self, source, target):
+        with self._lock:
+            if target not in self._futures:
+                self._futures[target] = self._pool.submit(
+                    self._copy, source, target)
+
+    def _copy(self, source, target):
+        os.makedirs(os.path.dirname(target), exist_ok = True)
+        devices = (os.stat(source).st_dev,
+                   os.stat(os.path.dirname(target)).st_dev)
+
+        # Write to a temporary name and move it into place, so an interrupted
+        # run never leaves a truncated file behind for the next to trust.
+        tmp = target + '.tmp'
+        for name, method in self._methods + [('copy', plain_copy)]:
+            if (name,) + devices in self._unsupported:
+                continue
+            if os.path.lexists(tmp):
+                os.remove(tmp)
+            try:
+                method(source, tmp)
+            except OSError as e:
+                if name == 'copy' or e.errno not in UNSUPPORTED:
+                    raise
+                with self._lock:
+                    self._unsupported.add((name,) + devices)
+                continue
+            os.replace(tmp, target)
+            with self._lock:
+                self.report[name] = self.report.get(name, 0) + 1
+            return name
+
+    def wait(self):
+        """
+        Wait for all the copies to finish, raising the first error if any
+        failed.
+        """
+        with self._lock:
+            futures = list(self._futures.values())
+        for future in concurrent.futures.as_completed(futures):
+            future.result()
+        return self.report
+
+    def close(self):
+        self._pool.shutdown()
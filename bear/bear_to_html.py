@@ -24,9 +24,12 @@
 This does a terrible job of markdown rendering, but it's better than nothing if you want to start off.
 """
 import argparse
+import concurrent.futures
+import hashlib
+import html
 import os.path, os
 import re
-import shutil
+import string
 
 import bear
 import sys
@@ -34,6 +37,71 @@ import markdown
 from markdown.inlinepatterns import Pattern
 from markdown.util import etree
 from markdown.extensions import Extension
+from bear.archive import ArchiveError, ArchiveExport
+from bear.assets import AssetCopier
+from bear.manifest import ExportManifest
+from bear.render_cache import RenderCache
+from bear.stats import format_summary
+
+
+HTML_TEMPLATE = """<html>
+    <head>
+        <title>{title}</title>{head}
+    </head>
+    <body>
+        <div class="note-wrapper">
+        {content}
+        </div>{body}
+    </body>
+</html>
+"""
+
+# The stylesheet goes either in every file, or in a file of its own which
+# every file links to.
+INLINE_STYLE = """
+        <style>{css}</style>"""
+LINKED_STYLE = """
+        <link rel="stylesheet" href="{href}">"""
+
+# Goes after the note content, with --backlinks
+BACKLINKS = """
+        <section class="backlinks">
+            <h2>Backlinks</h2>
+            <ul>{items}
+            </ul>
+        </section>"""
+BACKLINK_ITEM = """
+                <li><a href="{href}">{title}</a></li>"""
+
+
+class PageTemplate(object):
+    """
+    A str.format style template (with named fields only) that is parsed once,
+    rather than every time it's filled in. Fields given to the constructor
+    are filled in straight away.
+    """
+    def __init__(self, template, **fixed):
+        self._parts = []
+        literal = []
+        for text, field, spec, conversion in string.Formatter().parse(template):
+            literal.append(text)
+            if field is None:
+                continue
+            if field in fixed:
+                literal.append(str(fixed[field]))
+            else:
+                self._parts.append(''.join(literal))
+                self._parts.append(field)
+                literal = []
+        self._parts.append(''.join(literal))
+        self.source = ''.join('{' + p + '}' if i % 2 else p
+                              for i, p in enumerate(self._parts))
+
+    def render(self, **fields):
+        parts = self._parts[:]
+        for i in range(1, len(parts), 2):
+            parts[i] = fields[parts[i]]
+        return ''.join(parts)
 
 
 class ImagePattern(Pattern):
@@ -49,7 +117,15 @@ class ImagePattern(Pattern):
 
 class ImageExtension(Extension):
     def extendMarkdown(self, md, md_globals):
-        md.inlinePatterns.add('bearimage', ImagePattern(r'\[image:([^\]]+)\]', md),"<reference")
+        md.inlinePatterns.add('bearimage', ImagePattern(bear.IMAGE_RE.pattern, md),"<reference")
+
+
+def open_archive(path):
+    try:
+        return ArchiveExport(path)
+    except ArchiveError as e:
+        print(e)
+        sys.exit(1)
 
 
 def title_to_filename(path, title):
@@ -77,75 +153,249 @@ def get_css():
     return '<!-- Could not find style file, see get_css() in bear_to_html.py -->'
 
 
-def main():
+def make_parser():
     parser = argparse.ArgumentParser(description = 'Export Bear posts as Jekyll-compatible markdown')
-    parser.add_argument('output', type = str,
+    parser.add_argument('output', type = str, nargs = '?',
                         help = 'directory to output to')
+    parser.add_argument('--output-archive', type = str,
+                        help = 'write everything into this archive (.zip, .tar, .tar.gz, .tar.bz2, .tar.xz or .tar.zst) instead of a directory')
     parser.add_argument('--tag', type = str, action = 'append',
                         help = 'Tag to export, you can specify multiple times. If no tags are specified all posts will be exported')
+    parser.add_argument('--force', action = "store_true",
+                        help = "rewrite every note, even if it hasn't changed since the last export")
+    parser.add_argument('--jobs', '-j', type = int, default = 1,
+                        help = 'number of processes to render markdown with')
+    parser.add_argument('--watch', action = "store_true",
+                        help = "keep running, and export again whenever notes change")
+    parser.add_argument('--interval', type = float, default = 2.0,
+                        help = "how often to check for changes with --watch, in seconds")
+    parser.add_argument('--profile', action = "store_true",
+                        help = "print a summary of the database queries run at the end")
+    parser.add_argument('--link-images', action = "store_true",
+                        help = "hard link images rather than copying them, if they're on the same filesystem. Don't edit the exported images if you use this, you'd be editing Bear's copy too")
+    parser.add_argument('--image-jobs', type = int, default = 8,
+                        help = "number of images to copy at once")
+    parser.add_argument('--no-render-cache', action = "store_true",
+                        help = "don't use (or fill) the cache of rendered notes")
+    parser.add_argument('--inline-css', action = "store_true",
+                        help = "put the stylesheet in every file, rather than linking them all to one copy of it")
+    parser.add_argument('--backlinks', action = "store_true",
+                        help = "list the notes that link to each note at the bottom of it")
+    return parser
+
+
+def main():
+    parser = make_parser()
     args = parser.parse_args()
 
-    full_path = os.path.join(os.getcwd(), args.output)
+    if bool(args.output) == bool(args.output_archive):
+        parser.error("give either an output directory or --output-archive")
+    if args.output_archive and args.watch:
+        parser.error("--watch only works with an output directory")
+
+    full_path = os.path.join(os.getcwd(), args.output or '')
 
     # Check directory exists
-    if not os.path.isdir(full_path):
+    if args.output and not os.path.isdir(full_path):
         print("The given output directory {} does not exist".format(full_path))
         sys.exit(1)
 
     # Open Bear database
-    b = bear.Bear()
+    b = bear.Bear(instrument = args.profile)
+
+    # Start watching before the first export, so we don't miss anything that
+    # changes while it runs
+    feed = b.change_feed() if args.watch else None
+
+    export(b, args, full_path, args.force)
 
+    if feed:
+        # Only the notes that changed get written each time round, the
+        # manifest takes care of that.
+        print("Watching for changes, press Ctrl-C to stop")
+        try:
+            while True:
+                events = feed.wait(args.interval)
+                print("{} notes changed".format(len(events)))
+                export(b, args, full_path)
+        except KeyboardInterrupt:
+            pass
+
+    if args.profile:
+        print(format_summary(b.stats()))
+
+
+def export(b, args, full_path, force = False):
     # Check tags
-    if args.tag:
-        notes = []
-        for tag in args.tag:
-            t = b.tag_by_title(tag)
-            if not t:
-                print("The given tag '{}' does not exist - note they're case sensitive".format(tag))
-                sys.exit(1)
-            for note in t.notes():
-                notes.append(note)
-    else:
-        notes = b.notes()
+    for tag in args.tag or []:
+        if not b.tag_by_title(tag):
+            print("The given tag '{}' does not exist - note they're case sensitive".format(tag))
+            sys.exit(1)
+
+    # One query, and a note with several of the tags is only exported once
+    notes = b.query().any_tag(*(args.tag or [])).deleted(False).lazy()
 
     css = get_css()
+    template, stylesheet = page_template(css, args.inline_css)
+
+    # Notes that haven't changed since the last run are skipped, so their text
+    # is never even loaded
+    if args.output_archive:
+        manifest = open_archive(args.output_archive)
+    else:
+        manifest = ExportManifest(full_path, 'html', config = template.source, force = force,
+                                  copier = AssetCopier(args.image_jobs, args.link_images))
+    # The manifest removes the last run's stylesheet if it's not this one
+    if stylesheet:
+        manifest.add_bytes(stylesheet, css.encode('utf8'))
+
+    cache = None if args.no_render_cache else \
+        RenderCache(b.sidecar_path('render-cache.sqlite'))
+
+    # Every note's backlinks in one go, from the link index
+    backlinks = b.link_index().backlink_map() if args.backlinks else None
+
+    if args.jobs > 1:
+        export_parallel(notes, manifest, template, args.jobs, cache, backlinks)
+    else:
+        export_serial(notes, manifest, template, cache, backlinks)
+
+    manifest.finish()
+    print(manifest.summary())
+    if cache:
+        stats = cache.stats()
+        print("Render cache: {} hits, {} misses".format(stats['hits'], stats['misses']))
+        cache.close()
+
+
+def note_filename(note):
+    return title_to_filename('', note.title) + '.html'
+
 
-    # Iterate through all notes
+def page_template(css, inline):
+    """
+    The PageTemplate for each note, and the name of the stylesheet it links
+    to (None if inline). The name includes a hash of the stylesheet, so
+    browsers and caches can hang on to it for as long as they like.
+    """
+    if inline:
+        return PageTemplate(HTML_TEMPLATE, head = '', body = INLINE_STYLE.format(css = css)), None
+
+    name = 'bear-{}.css'.format(hashlib.sha1(css.encode('utf8')).hexdigest()[:12])
+    return PageTemplate(HTML_TEMPLATE, head = LINKED_STYLE.format(href = name), body = ''), name
+
+
+def backlinks_html(backlinks, note):
+    """
+    The backlinks section for the bottom of the note, or '' if there are no
+    backlinks (or backlinks is None, i.e. --backlinks wasn't given).
+    """
+    links = backlinks.get(note.id) if backlinks else None
+    if not links:
+        return ''
+    return BACKLINKS.format(items = ''.join(
+        BACKLINK_ITEM.format(href = html.escape(title_to_filename('', l.source_title) + '.html'),
+                             title = html.escape(l.source_title))
+        for l in links))
+
+
+def export_serial(notes, manifest, template, cache = None, backlinks = None):
     for note in notes:
-        # Create a suitable filename
-        filename = title_to_filename(full_path, note.title) + '.html'
-
-        # Write out the post
-        with open(filename, 'w', encoding = 'utf8') as f:
-            content = markdown.markdown(note.text,
-                                      extensions = [
-                                          ImageExtension(),
-                                          'markdown.extensions.nl2br',
-                                          'markdown.extensions.fenced_code'
-                                      ])
-            html = """<html>
-    <head>
-        <title>{}</title>
-    </head>
-    <body>
-        <div class="note-wrapper">
-        {}
-        </div>
-        <style>{}</style>
-    </body>
-</html>
-""".format(note.title, content, css)
-            f.write(html)
-
-            # Images to copy
-            for image in note.images():
-                if image.exists():
-                    # Figure out target path for image
-                    target_path = os.path.join(full_path, image.uri)
-                    # Make dir
-                    os.makedirs(os.path.dirname(target_path), exist_ok = True)
-                    # Copy file
-                    shutil.copyfile(image.path, target_path)
+        # The backlinks change when other notes do, so the manifest has to
+        # know about them too
+        extra = backlinks_html(backlinks, note)
+        manifest.export_note(note, note_filename(note), lambda: render_note(note, template, cache, extra),
+                             depends = extra or None)
+
+
+def export_parallel(notes, manifest, template, jobs, cache = None, backlinks = None):
+    """
+    Render notes in a pool of processes. We keep a few notes per process in
+    flight and write each one out as soon as it comes back, so memory use
+    stays flat however many notes there are. The database and render cache
+    are only ever touched from this process.
+    """
+    def write_html(note, content, extra):
+        page = template.render(title = note.title, content = content + extra)
+        manifest.write_note(note, note_filename(note), page, extra or None)
+
+    def write(futures):
+        for future in futures:
+            note, key, extra = pending.pop(future)
+            if cache:
+                cache.put(key, future.result())
+            write_html(note, future.result(), extra)
+
+    pending = {}
+    with concurrent.futures.ProcessPoolExecutor(jobs) as pool:
+        for note in notes:
+            extra = backlinks_html(backlinks, note)
+            if not manifest.check_note(note, note_filename(note), extra or None):
+                continue
+            key = None
+            if cache:
+                key = cache.key(note.text, renderer_config())
+                content = cache.get(key)
+                if content is not None:
+                    write_html(note, content, extra)
+                    continue
+            pending[pool.submit(render_markdown, note.text)] = (note, key, extra)
+            if len(pending) >= jobs * 4:
+                done, _ = concurrent.futures.wait(
+                    pending, return_when = concurrent.futures.FIRST_COMPLETED)
+                write(done)
+        write(concurrent.futures.as_completed(list(pending)))
+
+
+MARKDOWN_EXTENSIONS = [
+    'markdown.extensions.nl2br',
+    'markdown.extensions.fenced_code'
+]
+
+# Bump this when ImageExtension (or anything else here that changes the
+# output) changes, so the render cache doesn't serve up stale HTML.
+RENDERER_VERSION = 1
+
+
+def make_markdown():
+    return markdown.Markdown(extensions = [ImageExtension()] + MARKDOWN_EXTENSIONS)
+
+
+# Building a Markdown instance means setting up all its extensions, so each
+# process keeps one and resets it between notes.
+_markdown = None
+
+
+def render_markdown(text):
+    global _markdown
+    if _markdown is None:
+        _markdown = make_markdown()
+    _markdown.reset()
+    return _markdown.convert(text)
+
+
+def renderer_config():
+    """
+    Everything besides the text that affects render_markdown()'s output, for
+    the render cache key.
+    """
+    return 'bear_to_html {} markdown {} extensions {}'.format(
+        RENDERER_VERSION, markdown.__version__, ' '.join(MARKDOWN_EXTENSIONS))
+
+
+def render_note_html(text, cache = None):
+    """
+    Render a note's markdown to HTML (just the content, no page around it),
+    using the RenderCache if given.
+    """
+    if cache is None:
+        return render_markdown(text)
+    return cache.get_or_render(text, renderer_config(), render_markdown)
+
+
+def render_note(note, template, cache = None, extra = ''):
+    return template.render(title = note.title, content = render_note_html(note.text, cache) + extra)
+
 
 if __name__ == "__main__":
     main()
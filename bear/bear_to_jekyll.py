@@ -26,10 +26,39 @@ I really wanted to call this "inthewoods.py" but it seemed likely to cause confu
 import argparse
 import os.path, os
 import re
-import shutil
 
 import bear
 import sys
+from bear.archive import ArchiveError, ArchiveExport
+from bear.assets import AssetCopier
+from bear.manifest import ExportManifest
+from bear.stats import format_summary
+
+
+POST_TEMPLATE = """---
+    title: {}
+    date: {}
+    tags: {}
+    uuid: {}
+    ---
+    {}"""
+
+# Goes after the note text, with --backlinks. The links are to the other
+# exported .md files, which jekyll-relative-links turns into their URLs.
+BACKLINKS = """
+
+## Backlinks
+
+{}"""
+BACKLINK_ITEM = "* [{}]({}.md)\n"
+
+
+def open_archive(path):
+    try:
+        return ArchiveExport(path)
+    except ArchiveError as e:
+        print(e)
+        sys.exit(1)
 
 
 def title_to_filename(path, title):
@@ -42,62 +71,113 @@ def title_to_filename(path, title):
     return os.path.join(path, name)
 
 
-def main():
+def make_parser():
     parser = argparse.ArgumentParser(description = 'Export Bear posts as Jekyll-compatible markdown')
-    parser.add_argument('output', type = str,
+    parser.add_argument('output', type = str, nargs = '?',
                         help = 'directory to output to')
+    parser.add_argument('--output-archive', type = str, help = 'write everything into this archive (.zip, .tar, .tar.gz, .tar.bz2, .tar.xz or .tar.zst) instead of a directory')
     parser.add_argument('--tag', type = str, action='append', help='Tag to export, you can specify multiple times. If no tags are specified all posts will be exported')
     parser.add_argument('--html', action = "store_true", help = "render as html")
+    parser.add_argument('--force', action = "store_true", help = "rewrite every note, even if it hasn't changed since the last export")
+    parser.add_argument('--backlinks', action = "store_true", help = "list the notes that link to each note at the end of it")
+    parser.add_argument('--watch', action = "store_true", help = "keep running, and export again whenever notes change")
+    parser.add_argument('--interval', type = float, default = 2.0, help = "how often to check for changes with --watch, in seconds")
+    parser.add_argument('--profile', action = "store_true", help = "print a summary of the database queries run at the end")
+    parser.add_argument('--link-images', action = "store_true", help = "hard link images rather than copying them, if they're on the same filesystem. Don't edit the exported images if you use this, you'd be editing Bear's copy too")
+    parser.add_argument('--image-jobs', type = int, default = 8, help = "number of images to copy at once")
+    return parser
+
+
+def main():
+    parser = make_parser()
     args = parser.parse_args()
 
-    full_path = os.path.join(os.getcwd(), args.output)
+    if bool(args.output) == bool(args.output_archive):
+        parser.error("give either an output directory or --output-archive")
+    if args.output_archive and args.watch:
+        parser.error("--watch only works with an output directory")
+
+    full_path = os.path.join(os.getcwd(), args.output or '')
 
     # Check directory exists
-    if not os.path.isdir(full_path):
+    if args.output and not os.path.isdir(full_path):
         print("The given output directory {} does not exist".format(full_path))
         sys.exit(1)
 
     # Open Bear database
-    b = bear.Bear()
+    b = bear.Bear(instrument = args.profile)
+
+    # Start watching before the first export, so we don't miss anything that
+    # changes while it runs
+    feed = b.change_feed() if args.watch else None
+
+    export(b, args, full_path, args.force)
+
+    if feed:
+        # Only the notes that changed get written each time round, the
+        # manifest takes care of that.
+        print("Watching for changes, press Ctrl-C to stop")
+        try:
+            while True:
+                events = feed.wait(args.interval)
+                print("{} notes changed".format(len(events)))
+                export(b, args, full_path)
+        except KeyboardInterrupt:
+            pass
+
+    if args.profile:
+        print(format_summary(b.stats()))
 
+
+def export(b, args, full_path, force = False):
     # Check tags
-    if args.tag:
-        notes = []
-        for tag in args.tag:
-            t = b.tag_by_title(tag)
-            if not t:
-                print("The given tag '{}' does not exist - note they're case sensitive".format(tag))
-                sys.exit(1)
-            for note in t.notes():
-                notes.append(note)
+    for tag in args.tag or []:
+        if not b.tag_by_title(tag):
+            print("The given tag '{}' does not exist - note they're case sensitive".format(tag))
+            sys.exit(1)
+
+    # One query, and a note with several of the tags is only exported once
+    notes = b.query().any_tag(*(args.tag or [])).deleted(False).prefetch_tags().lazy()
+
+    # Notes that haven't changed since the last run are skipped, so their text
+    # is never even loaded
+    if args.output_archive:
+        manifest = open_archive(args.output_archive)
     else:
-        notes = b.notes()
+        manifest = ExportManifest(full_path, 'jekyll', config = POST_TEMPLATE, force = force,
+                                  copier = AssetCopier(args.image_jobs, args.link_images))
+
+    # Every note's backlinks in one go, from the link index
+    backlinks = b.link_index().backlink_map() if args.backlinks else None
 
     # Iterate through all notes
     for note in notes:
         # Create a suitable filename
-        filename = title_to_filename(full_path, note.title) + '.md'
+        filename = title_to_filename('', note.title) + '.md'
 
-        # Write out the post
-        with open(filename, 'w', encoding = 'utf8') as f:
+        # The backlinks change when other notes do, so the manifest has to
+        # know about them too
+        extra = backlinks_markdown(backlinks, note)
 
-            f.write("""---
-    title: {}
-    date: {}
-    tags: {}
-    uuid: {}
-    ---
-    {}""".format(note.title, note.created.strftime('%Y-%m-%d %H:%M:%S +0000'), ' '.join([t.title for t in note.tags()]), note.id, note.text))
-
-            # Images to copy
-            for image in note.images():
-                if image.exists():
-                    # Figure out target path for image
-                    target_path = os.path.join(full_path, image.uri)
-                    # Make dir
-                    os.makedirs(os.path.dirname(target_path), exist_ok = True)
-                    # Copy file
-                    shutil.copyfile(image.path, target_path)
+        # Write out the post, and its images
+        manifest.export_note(note, filename, lambda: render_post(note) + extra,
+                             depends = extra or None)
+
+    manifest.finish()
+    print(manifest.summary())
+
+
+def backlinks_markdown(backlinks, note):
+    links = backlinks.get(note.id) if backlinks else None
+    if not links:
+        return ''
+    return BACKLINKS.format(''.join(
+        BACKLINK_ITEM.format(l.source_title, title_to_filename('', l.source_title))
+        for l in links))
+
+
+def render_post(note):
+    return POST_TEMPLATE.format(note.title, note.created.strftime('%Y-%m-%d %H:%M:%S +0000'), ' '.join([t.title for t in note.tags()]), note.id, note.text)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,239 @@
+#
+# Copyright (c) 2020  Richard Clark
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+"""
+Benchmarks pybear against a synthetic database (see bear.synthetic), so they
+run anywhere, without Bear or a network. Results are printed and can be saved
+as JSON to compare between versions:
+
+    python -m bear.benchmark --notes 20000 --output before.json
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os.path
+import platform
+import sqlite3
+import statistics
+import tempfile
+import time
+
+import bear
+from bear import bear_to_jekyll, synthetic
+from bear.aio import AsyncBear
+
+
+def _export_args(module, **kwds):
+    # Start from the exporter's own defaults, so options added to it later
+    # don't break the benchmark. The render cache would make every run after
+    # the first one measure the cache rather than the rendering.
+    args = module.make_parser().parse_args([])
+    args.no_render_cache = True
+    args.__dict__.update(kwds)
+    return args
+
+
+def _export(module, b, output, force = True, **kwds):
+    # The exporters print a summary, which we don't want in the results
+    with contextlib.redirect_stdout(io.StringIO()):
+        module.export(b, _export_args(module, **kwds), output, force)
+
+
+def bench_notes(b, ctx):
+    for note in b.notes():
+        pass
+
+
+def bench_notes_lazy_titles(b, ctx):
+    for note in b.notes(lazy = True):
+        note.title
+
+
+def bench_notes_tags(b, ctx):
+    for note in b.notes(prefetch_tags = True, lazy = True):
+        list(note.tags())
+
+
+def bench_tag_notes_exact(b, ctx):
+    for tag in ctx['tags']:
+        for note in tag.notes(exact_match = True, lazy = True):
+            pass
+
+
+def bench_specific_tags(b, ctx):
+    for note in b.notes(prefetch_tags = True, lazy = True):
+        note.specific_tags()
+
+
+def bench_export_jekyll(b, ctx):
+    with tempfile.TemporaryDirectory() as output:
+        _export(bear_to_jekyll, b, output)
+
+
+def bench_export_jekyll_unchanged(b, ctx):
+    _export(bear_to_jekyll, b, ctx['jekyll_output'], force = False)
+
+
+def bench_export_html(b, ctx):
+    with tempfile.TemporaryDirectory() as output:
+        _export(ctx['bear_to_html'], b, output)
+
+
+def bench_search(b, ctx):
+    for word in ('garden', 'project meeting', 'rese*'):
+        b.search(word)
+
+
+def bench_async_streams(b, ctx):
+    # More streams than threads, each awaiting other calls inside its loop.
+    # That used to deadlock, so this gives up loudly rather than hanging.
+    async def stream(ab):
+        async for note in ab.notes(lazy = True, batch_size = 50):
+            await note.tags()
+            await note.load_text()
+
+    async def streams():
+        async with AsyncBear(ctx['database'], pool_size = 2,
+                cache_dir = ctx['cache_dir']) as ab:
+            await asyncio.wait_for(
+                asyncio.gather(*(stream(ab) for i in range(4))), 120)
+
+    asyncio.run(streams())
+
+
+BENCHMARKS = [
+    ('notes', bench_notes),
+    ('notes_lazy_titles', bench_notes_lazy_titles),
+    ('notes_tags', bench_notes_tags),
+    ('tag_notes_exact', bench_tag_notes_exact),
+    ('specific_tags', bench_specific_tags),
+    ('export_jekyll', bench_export_jekyll),
+    ('export_jekyll_unchanged', bench_export_jekyll_unchanged),
+    ('export_html', bench_export_html),
+    ('search', bench_search),
+    ('async_streams', bench_async_streams),
+]
+
+
+def run(database, cache_dir, repeat = 3, only = None):
+    """
+    Run the benchmarks against database and return a dict of name -> timings
+    in seconds. Each run gets a fresh Bear, so nothing is cached between
+    runs unless it's on disk.
+    """
+    ctx = {'database': database, 'cache_dir': cache_dir}
+    b = bear.Bear(database, cache_dir = cache_dir)
+    # Every tag with children, where exact_match has something to do
+    tree = b.tag_tree()
+    ctx['tags'] = [t for t in b.tags() if tree.children(t)]
+
+    try:
+        from bear import bear_to_html
+        ctx['bear_to_html'] = bear_to_html
+    except ImportError:
+        bear_to_html = None
+
+    results = {}
+    with tempfile.TemporaryDirectory() as jekyll_output:
+        ctx['jekyll_output'] = jekyll_output
+        _export(bear_to_jekyll, b, jekyll_output)
+
+        for name, fn in BENCHMARKS:
+            if only and name not in only:
+                continue
+            if name == 'export_html' and bear_to_html is None:
+                print('{:28} skipped, Markdown is not installed'.format(name))
+                continue
+
+            times = []
+            for i in range(repeat):
+                b = bear.Bear(database, cache_dir = cache_dir)
+                start = time.perf_counter()
+                fn(b, ctx)
+                times.append(time.perf_counter() - start)
+                b.close()
+
+            results[name] = {
+                'min': min(times),
+                'median': statistics.median(times),
+                'runs': times,
+            }
+            print('{:28} min {:9.4f}s  median {:9.4f}s'.format(
+                name, min(times), statistics.median(times)))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Benchmark pybear on a synthetic Bear database')
+    parser.add_argument('--database', type = str,
+                        help = 'use this database instead of generating one')
+    parser.add_argument('--notes', type = int, default = 5000)
+    parser.add_argument('--text-length', type = int, default = 2000)
+    parser.add_argument('--tag-depth', type = int, default = 3)
+    parser.add_argument('--tags-per-note', type = int, default = 2)
+    parser.add_argument('--images-per-note', type = float, default = 0.2)
+    parser.add_argument('--repeat', type = int, default = 3)
+    parser.add_argument('--only', type = str, action = 'append',
+                        help = 'only run this benchmark, you can specify multiple times')
+    parser.add_argument('--output', type = str,
+                        help = 'write the results to this JSON file')
+    args = parser.parse_args()
+
+    params = {
+        'notes': args.notes,
+        'text_length': args.text_length,
+        'tag_depth': args.tag_depth,
+        'tags_per_note': args.tags_per_note,
+        'images_per_note': args.images_per_note,
+    }
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database = args.database
+        if database:
+            params = {'database': os.path.abspath(database)}
+        else:
+            database = os.path.join(tmp, 'database.sqlite')
+            start = time.perf_counter()
+            synthetic.generate(database, **params)
+            print('Generated {} notes in {:.1f}s'.format(
+                args.notes, time.perf_counter() - start))
+
+        results = run(database, os.path.join(tmp, 'cache'), args.repeat,
+                      args.only)
+
+    if args.output:
+        with open(args.output, 'w', encoding = 'utf8') as f:
+            json.dump({
+                'pybear': bear.__version__,
+                'python': platform.python_version(),
+                'sqlite': sqlite3.sqlite_version,
+                'platform': platform.platform(),
+                'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+                'params': params,
+                'results': results,
+            }, f, indent = 2)
+
+
+if __name__ == "__main__":
+    main()
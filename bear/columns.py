@@ -0,0 +1,338 @@
+#
+# Copyright (c) 2020  Richard Clark
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+"""
+Notes as columns rather than objects, for reporting: notes created per week,
+how long they are, which tags go together. Everything is read in a couple of
+bulk queries straight into flat arrays, without making a Note for each row.
+
+    cols = b.to_columns()
+    cols.save('notes.snapshot')
+    ...
+    cols = Columns.load('notes.snapshot', numpy = True)
+    print(cols['length'].mean())
+
+The columns are the standard library's array.array (or lists, for strings),
+or numpy arrays if numpy is installed and asked for. A saved snapshot is one
+file that's memory mapped when it's loaded, so opening it is instant however
+big it is, and Bear's database isn't needed at all.
+"""
+import array
+import json
+import mmap
+import os
+import struct
+import sys
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+# Core Data timestamps are seconds since 1 Jan 2001 UTC; the date columns are
+# seconds since 1 Jan 1970 UTC, i.e. Unix time, with NaN where there's no date.
+COREDATA_EPOCH = 978307200.0
+
+MAGIC = b'PYBEARC1'
+VERSION = 1
+ALIGN = 8
+
+# name, array typecode ('str' for strings), and the SQL it's read with
+NOTE_COLUMNS = [
+    ('pk', 'q', 'Z_PK'),
+    ('id', 'str', 'ZUNIQUEIDENTIFIER'),
+    ('title', 'str', 'ZTITLE'),
+    ('created', 'd', 'ZCREATIONDATE + {}'.format(COREDATA_EPOCH)),
+    ('modified', 'd', 'ZMODIFICATIONDATE + {}'.format(COREDATA_EPOCH)),
+    ('archived_date', 'd', 'ZARCHIVEDDATE + {}'.format(COREDATA_EPOCH)),
+    ('trashed_date', 'd', 'ZTRASHEDDATE + {}'.format(COREDATA_EPOCH)),
+    ('archived', 'b', 'ZARCHIVED != 0'),
+    ('trashed', 'b', 'ZTRASHED != 0'),
+    ('deleted', 'b', 'ZPERMANENTLYDELETED != 0'),
+    ('pinned', 'b', 'ZPINNED != 0'),
+    # Characters, worked out by SQLite without handing us the text
+    ('length', 'q', 'LENGTH(ZTEXT)'),
+]
+
+TAG_COLUMNS = [
+    ('tag_pk', 'q', 'Z_PK'),
+    ('tag_title', 'str', 'ZTITLE'),
+]
+
+_NULLS = {'q': 0, 'd': float('nan'), 'b': 0, 'str': ''}
+
+_NUMPY_TYPES = {'q': 'int64', 'd': 'float64', 'b': 'int8', 'i': 'int32'}
+
+
+class StringColumn(object):
+    """
+    Strings stored the way Arrow does: UTF-8 bytes end to end, and offsets
+    into them. Each string is only decoded when it's asked for.
+    """
+    def __init__(self, offsets, data):
+        self._offsets = offsets
+        self._data = data
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        return bytes(self._data[self._offsets[i]:self._offsets[i + 1]]).decode('utf8')
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def tolist(self):
+        return list(self)
+
+
+def _encode_strings(values):
+    offsets = array.array('q', [0])
+    data = bytearray()
+    for value in values:
+        data += value.encode('utf8')
+        offsets.append(len(data))
+    return offsets, data
+
+
+class Columns(object):
+    """
+    One entry per note in each of the NOTE_COLUMNS, in Z_PK order, plus the
+    tags as TAG_COLUMNS and a CSR index from notes to them: the tags of note
+    i are tag_indices[tag_indptr[i]:tag_indptr[i + 1]], as positions in the
+    tag columns. Get columns with cols['title'] or cols.title.
+    """
+    def __init__(self, columns, backend = 'array', mapped = None):
+        self._columns = columns
+        self.backend = backend
+        self._mmap = mapped
+
+    def __len__(self):
+        return len(self._columns['pk'])
+
+    def __getitem__(self, name):
+        return self._columns[name]
+
+    def __getattr__(self, name):
+        try:
+            return self._columns[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    @property
+    def names(self):
+        return list(self._columns)
+
+    def note_tags(self, i):
+        """
+        The titles of note i's tags.
+        """
+        indptr = self._columns['tag_indptr']
+        titles = self._columns['tag_title']
+        return [titles[int(t)] for t in
+                self._columns['tag_indices'][int(indptr[i]):int(indptr[i + 1])]]
+
+    def to_numpy(self):
+        """
+        The same columns as numpy arrays (object arrays for strings). Numbers
+        aren't copied.
+        """
+        _need_numpy()
+        columns = {}
+        for name, column in self._columns.items():
+            if isinstance(column, (list, StringColumn)):
+                columns[name] = np.array(list(column), dtype = object)
+            else:
+                columns[name] = np.asarray(column)
+        return Columns(columns, 'numpy', self._mmap)
+
+    def save(self, path):
+        """
+        Write a snapshot file that load() can map straight back in. It's
+        written alongside and renamed into place, so readers never see half
+        of one.
+        """
+        buffers = []
+        directory = {}
+        offset = 0
+
+        def add(name, typecode, data):
+            nonlocal offset
+            data = memoryview(data).cast('B')
+            offset += -offset % ALIGN
+            directory[name] = {'type': typecode, 'offset': offset,
+                               'bytes': len(data)}
+            buffers.append((offset, data))
+            offset += len(data)
+
+        for name, column in self._columns.items():
+            typecode = _typecode(name)
+            if typecode == 'str':
+                offsets, data = _encode_strings(column)
+                add(name + '.offsets', 'q', offsets)
+                add(name + '.data', 'B', data)
+            else:
+                if not isinstance(column, (array.array, memoryview)):
+                    column = array.array(typecode, column)
+                add(name, typecode, column)
+
+        header = json.dumps({
+            'version': VERSION,
+            'byteorder': sys.byteorder,
+            'rows': len(self),
+            'columns': directory,
+        }).encode('utf8')
+        start = len(MAGIC) + 8 + len(header)
+        start += -start % ALIGN
+
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(MAGIC + struct.pack('<Q', len(header)) + header)
+            f.write(b'\0' * (start - f.tell()))
+            for at, data in buffers:
+                f.write(b'\0' * (start + at - f.tell()))
+                f.write(data)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path, numpy = False):
+        """
+        Map a snapshot written by save(). Nothing is read until it's used.
+        With numpy=True the number columns are numpy arrays over the mapped
+        file; strings are StringColumns either way.
+        """
+        if numpy:
+            _need_numpy()
+        with open(path, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+
+        if mapped[:len(MAGIC)] != MAGIC:
+            raise ValueError('{} is not a pybear snapshot'.format(path))
+        size, = struct.unpack('<Q', mapped[len(MAGIC):len(MAGIC) + 8])
+        header = json.loads(mapped[len(MAGIC) + 8:len(MAGIC) + 8 + size])
+        if header['version'] != VERSION:
+            raise ValueError('{} is a version {} snapshot, this is version {}'.format(
+                path, header['version'], VERSION))
+        if header['byteorder'] != sys.byteorder:
+            raise ValueError('{} was written on a {} endian machine'.format(
+                path, header['byteorder']))
+        start = len(MAGIC) + 8 + size
+        start += -start % ALIGN
+
+        view = memoryview(mapped)
+
+        def column(name):
+            info = header['columns'][name]
+            at = start + info['offset']
+            if numpy and info['type'] in _NUMPY_TYPES:
+                return np.frombuffer(
+                    mapped, _NUMPY_TYPES[info['type']],
+                    info['bytes'] // struct.calcsize(info['type']), at)
+            return view[at:at + info['bytes']].cast(info['type'])
+
+        columns = {}
+        for name in header['columns']:
+            if name.endswith('.data'):
+                continue
+            if name.endswith('.offsets'):
+                base = name[:-len('.offsets')]
+                columns[base] = StringColumn(column(name), column(base + '.data'))
+            else:
+                columns[name] = column(name)
+        return cls(columns, 'numpy' if numpy else 'array', mapped)
+
+    def close(self):
+        """
+        Unmap a loaded snapshot, once nothing is holding on to its columns.
+        """
+        if self._mmap is not None:
+            self._columns = {}
+            self._mmap.close()
+            self._mmap = None
+
+
+def _need_numpy():
+    if np is None:
+        raise ImportError('numpy columns need the numpy package '
+                          '(pip install numpy)')
+
+
+def _typecode(name):
+    for column, typecode, sql in NOTE_COLUMNS + TAG_COLUMNS:
+        if column == name:
+            return typecode
+    return 'i' if name == 'tag_indices' else 'q'
+
+
+def _read(cursor, columns, table, order):
+    values = {name: ([] if typecode == 'str' else array.array(typecode))
+              for name, typecode, sql in columns}
+    cursor.execute('SELECT {} FROM {} ORDER BY {}'.format(
+        ', '.join(sql for name, typecode, sql in columns), table, order))
+    appends = [(values[name].append, _NULLS[typecode])
+               for name, typecode, sql in columns]
+    while True:
+        rows = cursor.fetchmany(5000)
+        if not rows:
+            break
+        for row in rows:
+            for (append, null), value in zip(appends, row):
+                append(null if value is None else value)
+    return values
+
+
+def read_columns(bear, numpy = False):
+    """
+    Read every note (trashed and deleted ones too, there are columns to
+    filter on) and tag into a Columns. See Bear.to_columns().
+    """
+    if numpy:
+        _need_numpy()
+    cursor = bear._cursor('Bear.to_columns')
+    columns = _read(cursor, NOTE_COLUMNS, 'ZSFNOTE', 'Z_PK')
+    columns.update(_read(cursor, TAG_COLUMNS, 'ZSFNOTETAG', 'Z_PK'))
+
+    row_of = {pk: i for i, pk in enumerate(columns['pk'])}
+    tag_of = {pk: i for i, pk in enumerate(columns['tag_pk'])}
+    counts = [0] * len(row_of)
+    indices = array.array('i')
+    # Both sides are in Z_PK order, so the tags come out grouped by row
+    cursor.execute('SELECT Z_7NOTES, Z_14TAGS FROM Z_7TAGS ORDER BY Z_7NOTES, Z_14TAGS')
+    for rows in iter(lambda: cursor.fetchmany(5000), []):
+        for note, tag in rows:
+            if note in row_of and tag in tag_of:
+                counts[row_of[note]] += 1
+                indices.append(tag_of[tag])
+
+    indptr = array.array('q', [0])
+    total = 0
+    for count in counts:
+        total += count
+        indptr.append(total)
+    columns['tag_indptr'] = indptr
+    columns['tag_indices'] = indices
+
+    result = Columns(columns)
+    return result.to_numpy() if numpy else result
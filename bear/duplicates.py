@@ -0,0 +1,300 @@
+#
+# Copyright (c) 2020  Richard Clark
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+"""
+Finding notes that are nearly the same as each other - web clips saved
+twice, copies of a template - without comparing every note with every
+other.
+
+Each note's text gets a MinHash signature: the words are split into
+overlapping shingles of a few words each, and the signature is a small sample
+of their hashes that's the same for the same set of shingles. Two notes'
+signatures agree in about the same proportion as their shingles do (the
+Jaccard similarity). We use one permutation hashing, which needs one hash per
+shingle rather than one per shingle per signature slot.
+
+Comparing signatures is still one pair at a time, so they're cut into bands
+and each band hashed into buckets (locality sensitive hashing): notes sharing
+a bucket in any band are candidates, and only candidates are compared. That
+makes the whole thing roughly linear in the number of notes.
+
+Signatures are kept in a separate SQLite file, like the search index, with
+each note's modification date, so a rerun only hashes notes that changed.
+Bear's own database is only ever read.
+
+    python -m bear.duplicates --threshold 0.8
+"""
+import argparse
+import array
+import collections
+import re
+import sqlite3
+import threading
+import zlib
+
+from .search import note_changes
+
+
+WORD_RE = re.compile(r'\w+')
+
+MAX_HASH = (1 << 64) - 1
+
+# Shingles are hashed with two CRC32s (fast, and the same in every process,
+# unlike hash()), mixed by multiplying with an odd constant so the top bits,
+# which pick the slot, depend on all of them.
+CRC_SEED = 0x5bd1e995
+MIX = 0x9E3779B97F4A7C15
+
+
+def shingles(text, size = 3):
+    """
+    The set of runs of size words in text, ignoring case and punctuation.
+    Texts shorter than that are one shingle.
+    """
+    words = WORD_RE.findall(text.lower())
+    if len(words) <= size:
+        return {' '.join(words)} if words else set()
+    return set(map(' '.join, zip(*(words[i:] for i in range(size)))))
+
+
+def signature(text, num_perm = 128, shingle_size = 3):
+    """
+    The MinHash signature of text, as an array of num_perm 64 bit integers,
+    or None if it has no words. Each shingle's hash picks a slot and competes
+    to be the smallest in it; empty slots borrow from the next slot along
+    (with a different offset for each distance, so borrowed values don't
+    look like matches).
+    """
+    items = shingles(text, shingle_size)
+    if not items:
+        return None
+
+    crc = zlib.crc32
+    slots = [MAX_HASH] * num_perm
+    for item in items:
+        data = item.encode('utf8')
+        h = ((crc(data) << 32 | crc(data, CRC_SEED)) * MIX) & MAX_HASH
+        slot = h * num_perm >> 64
+        if h < slots[slot]:
+            slots[slot] = h
+
+    if MAX_HASH in slots:
+        filled = [i for i, v in enumerate(slots) if v != MAX_HASH]
+        for i in range(num_perm):
+            if slots[i] == MAX_HASH:
+                distance = min((j - i) % num_perm for j in filled)
+                slots[i] = (slots[(i + distance) % num_perm]
+                            + distance * 0x9E3779B97F4A7C15) & MAX_HASH
+    return array.array('Q', slots)
+
+
+def similarity(a, b):
+    """
+    Estimated Jaccard similarity of the texts with signatures a and b.
+    """
+    return sum(1 for x, y in zip(a, b) if x == y) / len(a)
+
+
+def bands_for(threshold, num_perm, recall = 0.95):
+    """
+    The (bands, rows) split of a num_perm signature with the fewest bands
+    that still gives notes threshold similar a recall chance of sharing a
+    bucket in at least one band. Candidates are checked properly afterwards,
+    so it's better to have too many than to miss some.
+    """
+    for rows in range(num_perm, 0, -1):
+        if num_perm % rows:
+            continue
+        bands = num_perm // rows
+        if 1 - (1 - threshold ** rows) ** bands >= recall:
+            return bands, rows
+    return num_perm, 1
+
+
+class DuplicateCluster(object):
+    """
+    A group of notes that are all similar to at least one other in it. ids
+    and titles are in the same order, oldest note first.
+    """
+    def __init__(self, bear, ids, titles):
+        self._bear = bear
+        self.ids = ids
+        self.titles = titles
+
+    def notes(self):
+        return self._bear.get_notes(self.ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __str__(self):
+        return "{} notes: {}".format(len(self.ids), ', '.join(
+            '({}) {}'.format(id, title) for id, title in zip(self.ids, self.titles)))
+
+
+class DuplicateIndex(object):
+    """
+    Signatures of every note that isn't trashed or deleted. refresh() only
+    rehashes notes modified since last time (see note_changes()). Changing
+    num_perm or shingle_size means starting again, which happens
+    automatically.
+    """
+    def __init__(self, bear, path, num_perm = 128, shingle_size = 3):
+        self._bear = bear
+        self._path = path
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        self._db = sqlite3.connect(path, check_same_thread = False)
+        self._lock = threading.Lock()
+        self._db.executescript('''
+            CREATE TABLE IF NOT EXISTS settings (
+                num_perm        INTEGER,
+                shingle_size    INTEGER
+            );
+            CREATE TABLE IF NOT EXISTS signature (
+                Z_PK                INTEGER PRIMARY KEY,
+                ZUNIQUEIDENTIFIER   VARCHAR,
+                ZTITLE              VARCHAR,
+                ZCREATIONDATE       TIMESTAMP,
+                ZMODIFICATIONDATE   TIMESTAMP,
+                minhash             BLOB
+            );
+        ''')
+        with self._db:
+            settings = self._db.execute('SELECT * FROM settings').fetchone()
+            if settings != (num_perm, shingle_size):
+                self._db.execute('DELETE FROM settings')
+                self._db.execute('DELETE FROM signature')
+                self._db.execute('INSERT INTO settings VALUES (?, ?)',
+                                 [num_perm, shingle_size])
+
+    def close(self):
+        self._db.close()
+
+    def refresh(self):
+        """
+        Bring the signatures up to date with the Bear database. Returns a
+        tuple of (notes hashed, notes removed).
+        """
+        with self._lock:
+            return self._refresh()
+
+    def _refresh(self):
+        changed, removed = note_changes(self._bear, self._db, 'signature',
+            'Z_PK, ZUNIQUEIDENTIFIER, ZTITLE, ZCREATIONDATE, '
+            'ZMODIFICATIONDATE, ZTEXT', 'DuplicateIndex.refresh')
+        rows = []
+        for row in changed:
+            minhash = signature(row['ZTEXT'] or '', self.num_perm,
+                                self.shingle_size)
+            rows.append((row['Z_PK'], row['ZUNIQUEIDENTIFIER'],
+                         row['ZTITLE'], row['ZCREATIONDATE'],
+                         row['ZMODIFICATIONDATE'],
+                         minhash.tobytes() if minhash else None))
+
+        with self._db:
+            self._db.executemany('DELETE FROM signature WHERE Z_PK = ?',
+                                 [(pk,) for pk in removed])
+            self._db.executemany(
+                'INSERT OR REPLACE INTO signature VALUES (?, ?, ?, ?, ?, ?)',
+                rows)
+
+        return len(rows), len(removed)
+
+    def _signatures(self):
+        cursor = self._db.execute('''
+            SELECT ZUNIQUEIDENTIFIER, ZTITLE, minhash FROM signature
+            WHERE minhash IS NOT NULL
+            ORDER BY ZCREATIONDATE, Z_PK
+        ''')
+        for id, title, minhash in cursor:
+            yield id, title, array.array('Q', minhash)
+
+    def clusters(self, threshold = 0.8):
+        """
+        Groups of notes whose estimated similarity is at least threshold
+        (0 to 1) to another note in the group, biggest group first. Call
+        refresh() first.
+        """
+        with self._lock:
+            return self._clusters(threshold)
+
+    def _clusters(self, threshold):
+        bands, rows = bands_for(threshold, self.num_perm)
+        ids = []
+        titles = []
+        signatures = []
+        for id, title, minhash in self._signatures():
+            ids.append(id)
+            titles.append(title)
+            signatures.append(minhash)
+
+        # Union-find over note positions
+        parent = list(range(len(ids)))
+
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        for band in range(bands):
+            buckets = {}
+            start = band * rows
+            for i, minhash in enumerate(signatures):
+                key = minhash[start:start + rows].tobytes()
+                first = buckets.setdefault(key, i)
+                # Compared with the first note in the bucket, not each other
+                # one, so a bucket of a thousand copies is a thousand
+                # comparisons rather than half a million
+                if first != i and find(first) != find(i) \
+                        and similarity(signatures[first], minhash) >= threshold:
+                    parent[find(i)] = find(first)
+
+        groups = collections.defaultdict(list)
+        for i in range(len(ids)):
+            groups[find(i)].append(i)
+
+        clusters = [DuplicateCluster(self._bear, [ids[i] for i in members],
+                                     [titles[i] for i in members])
+                    for members in groups.values() if len(members) > 1]
+        clusters.sort(key = len, reverse = True)
+        return clusters
+
+
+def main():
+    import bear
+
+    parser = argparse.ArgumentParser(description = 'List groups of nearly identical notes')
+    parser.add_argument('--threshold', type = float, default = 0.8,
+                        help = 'how similar notes must be to count, from 0 to 1')
+    parser.add_argument('--database', type = str,
+                        help = "Bear database to read, if not Bear's own")
+    args = parser.parse_args()
+
+    b = bear.Bear(args.database, read_only = True)
+    for cluster in b.find_duplicates(args.threshold):
+        print(cluster)
+
+
+if __name__ == "__main__":
+    main()
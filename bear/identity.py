@@ -0,0 +1,182 @@
+#
+# Copyright (c) 2020  Richard Clark
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+"""
+An identity map for a long running Bear: each tag and note is loaded once and
+the same object handed back on every lookup, until the database changes.
+
+    b = bear.Bear(identity_map = True)
+
+Notes are kept in least recently used order, and the oldest dropped once
+there are more than max_notes of them or their text adds up to more than
+max_text_bytes. Tags are few, so they're all kept.
+
+Whether the database has changed is SQLite's data_version, which goes up
+whenever another connection (Bear, usually) commits. It's only meaningful
+asked of the same connection every time, so the map keeps one of its own.
+Asking is cheap, it doesn't touch the disk, so it's done on every lookup.
+"""
+import collections
+import threading
+
+from .pool import DataVersion
+
+
+class IdentityMap(object):
+    def __init__(self, max_notes = 10000, max_text_bytes = 64 * 1024 * 1024):
+        self.max_notes = max_notes
+        self.max_text_bytes = max_text_bytes
+        self._data_version = None
+        self._lock = threading.RLock()
+        self._notes = collections.OrderedDict()
+        self._text_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.clear()
+
+    def open(self, path):
+        """
+        Start watching the database at path. Bear does this when it's given
+        the map.
+        """
+        self._data_version = DataVersion(path)
+        self._data_version.changed()
+
+    def close(self):
+        if self._data_version is not None:
+            self._data_version.close()
+
+    def changed(self):
+        """
+        Has the database changed since last time we looked? If so everything
+        is dropped, and the caller should forget anything else it's cached.
+        """
+        if self._data_version is None:
+            return False
+        with self._lock:
+            if not self._data_version.changed():
+                return False
+            self.clear()
+            return True
+
+    def clear(self):
+        with self._lock:
+            self._tags_by_id = {}
+            self._tags_by_title = {}
+            self._all_tags = None
+            self._notes.clear()
+            self._text_bytes = 0
+
+    # Tags
+
+    def tag(self, tag):
+        """
+        The cached Tag with tag's id, caching tag itself if there isn't one.
+        """
+        with self._lock:
+            cached = self._tags_by_id.get(tag.id)
+            if cached is not None and cached.title == tag.title:
+                return cached
+            self._tags_by_id[tag.id] = tag
+            self._tags_by_title[tag.title] = tag
+            return tag
+
+    def tag_by_id(self, id):
+        return self._count(self._tags_by_id.get(id))
+
+    def tag_by_title(self, title):
+        """
+        The cached Tag, or None if it isn't cached. If every tag is cached,
+        that means there's no such tag, see has_all_tags().
+        """
+        return self._count(self._tags_by_title.get(title))
+
+    def all_tags(self):
+        """
+        Every tag, if set_all_tags() has been called since the last change,
+        otherwise None.
+        """
+        return self._count(self._all_tags)
+
+    def set_all_tags(self, tags):
+        with self._lock:
+            self._all_tags = [self.tag(t) for t in tags]
+            return self._all_tags
+
+    def has_all_tags(self):
+        return self._all_tags is not None
+
+    # Notes
+
+    def note(self, id):
+        with self._lock:
+            note = self._notes.get(id)
+            if note is not None:
+                self._notes.move_to_end(id)
+            return self._count(note)
+
+    def holds(self, note):
+        """
+        Is this very note object cached? Unlike note() it doesn't count as a
+        use, or as a hit or miss.
+        """
+        with self._lock:
+            return self._notes.get(note.id) is note
+
+    def add_note(self, note):
+        """
+        Cache note, unless there's one with that id already, and return
+        whichever is cached.
+        """
+        with self._lock:
+            cached = self._notes.get(note.id)
+            if cached is not None:
+                self._notes.move_to_end(note.id)
+                return cached
+            self._notes[note.id] = note
+            self._text_bytes += _text_bytes(note)
+            while len(self._notes) > self.max_notes \
+                    or self._text_bytes > self.max_text_bytes:
+                _, old = self._notes.popitem(last = False)
+                self._text_bytes -= _text_bytes(old)
+            return note
+
+    def _count(self, found):
+        if found is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return found
+
+    def stats(self):
+        return {
+            'notes': len(self._notes),
+            'text_bytes': self._text_bytes,
+            'tags': len(self._tags_by_id),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+def _text_bytes(note):
+    text = note._text
+    return len(text.encode('utf8')) if isinstance(text, str) else 0
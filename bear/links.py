@@ -0,0 +1,199 @@
+#
+# Copyright (c) 2020  Richard Clark
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+"""
+An index of the [[Note Title]] links between notes, kept in a separate SQLite
+file like the search index, so "what links here" doesn't mean reading every
+note. Links are stored as written and resolved to notes by title when they're
+looked up, so renaming a note doesn't mean reparsing everything that links to
+it. Bear's own database is only ever read.
+"""
+import collections
+import sqlite3
+import threading
+
+from . import markup
+from .search import note_changes
+
+
+# source and source_title are the note the link is in. target is the link as
+# written; id and title are the note it resolves to, or None if it doesn't.
+WikiLink = collections.namedtuple(
+    'WikiLink', 'source source_title target id title')
+
+
+def split_target(target):
+    """
+    The title a wiki link is after, and the title without a trailing
+    /Heading (Bear's links to a heading in a note), or None if there's no
+    '/'. Titles can contain '/' too, so both are tried. An |alias is dropped.
+    """
+    target = target.split('|', 1)[0].strip()
+    base = target.rsplit('/', 1)[0].strip() if '/' in target else None
+    return target, base or None
+
+
+class LinkIndex(object):
+    """
+    refresh() only reparses the notes that changed since last time (see
+    note_changes()) and drops the ones that were trashed or deleted.
+
+    A link resolves to the note with that title (ignoring case), or failing
+    that to the note named by the part before the last '/'. If several notes
+    have the same title, the most recently modified wins.
+    """
+
+    def __init__(self, bear, path):
+        self._bear = bear
+        self._path = path
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._db.executescript('''
+            CREATE TABLE IF NOT EXISTS link_note (
+                Z_PK                INTEGER PRIMARY KEY,
+                ZUNIQUEIDENTIFIER   VARCHAR,
+                ZTITLE              VARCHAR COLLATE NOCASE,
+                ZMODIFICATIONDATE   TIMESTAMP
+            );
+            CREATE INDEX IF NOT EXISTS link_note_title ON link_note (ZTITLE);
+            CREATE TABLE IF NOT EXISTS link (
+                source      INTEGER,
+                position    INTEGER,
+                target      VARCHAR COLLATE NOCASE,
+                base        VARCHAR COLLATE NOCASE
+            );
+            CREATE INDEX IF NOT EXISTS link_source ON link (source);
+            CREATE INDEX IF NOT EXISTS link_target ON link (target);
+            CREATE INDEX IF NOT EXISTS link_base ON link (base);
+            CREATE VIEW IF NOT EXISTS resolved_link AS
+                SELECT link.source, link.position, link.target, link.base,
+                    COALESCE(
+                        (SELECT Z_PK FROM link_note
+                         WHERE ZTITLE = link.target
+                         ORDER BY ZMODIFICATIONDATE DESC LIMIT 1),
+                        (SELECT Z_PK FROM link_note
+                         WHERE ZTITLE = link.base
+                         ORDER BY ZMODIFICATIONDATE DESC LIMIT 1)) AS dest
+                FROM link;
+        ''')
+
+    def close(self):
+        self._db.close()
+
+    def refresh(self):
+        """
+        Bring the index up to date with the Bear database. Returns a tuple of
+        (notes indexed, notes removed).
+        """
+        with self._lock:
+            return self._refresh()
+
+    def _refresh(self):
+        changed, removed = note_changes(self._bear, self._db, 'link_note',
+            'Z_PK, ZUNIQUEIDENTIFIER, ZMODIFICATIONDATE, ZTITLE, ZTEXT',
+            'LinkIndex.refresh')
+        indexed = 0
+        with self._db:
+            for pk in removed:
+                self._delete(pk)
+
+            for row in changed:
+                self._delete(row['Z_PK'])
+                self._db.execute(
+                    'INSERT INTO link_note VALUES (?, ?, ?, ?)',
+                    [row['Z_PK'], row['ZUNIQUEIDENTIFIER'], row['ZTITLE'],
+                     row['ZMODIFICATIONDATE']])
+                links = [l for l in markup.parse(row['ZTEXT']).links
+                         if l.kind == 'wiki']
+                self._db.executemany(
+                    'INSERT INTO link VALUES (?, ?, ?, ?)',
+                    [(row['Z_PK'], position) + split_target(l.target)
+                     for position, l in enumerate(links)])
+                indexed += 1
+
+        return indexed, len(removed)
+
+    def _delete(self, pk):
+        self._db.execute('DELETE FROM link WHERE source = ?', [pk])
+        self._db.execute('DELETE FROM link_note WHERE Z_PK = ?', [pk])
+
+    def _links(self, where, params):
+        # One row per (source, target), in the order they appear in the note
+        cursor = self._db.execute('''
+            SELECT src.ZUNIQUEIDENTIFIER, src.ZTITLE, r.target,
+                dst.ZUNIQUEIDENTIFIER, dst.ZTITLE
+            FROM resolved_link AS r
+            JOIN link_note AS src ON src.Z_PK = r.source
+            LEFT JOIN link_note AS dst ON dst.Z_PK = r.dest
+            WHERE {}
+            GROUP BY r.source, r.target
+            ORDER BY r.source, MIN(r.position)
+        '''.format(where), params)
+        return [WikiLink(*row) for row in cursor.fetchall()]
+
+    def outlinks(self, id):
+        """
+        The links in note id, resolved or not.
+        """
+        with self._lock:
+            return self._links('src.ZUNIQUEIDENTIFIER = ?', [id])
+
+    def backlinks(self, id):
+        """
+        The links to note id from other notes (or itself).
+        """
+        with self._lock:
+            row = self._db.execute(
+                'SELECT Z_PK, ZTITLE FROM link_note WHERE ZUNIQUEIDENTIFIER = ?',
+                [id]).fetchone()
+            if row is None:
+                return []
+            # The indexes on target and base narrow it down before resolving
+            return _by_source(self._links(
+                '(r.target = ? OR r.base = ?) AND r.dest = ?',
+                [row[1], row[1], row[0]]))
+
+    def unresolved(self):
+        """
+        Every link that doesn't lead to a note.
+        """
+        with self._lock:
+            return self._links('r.dest IS NULL', [])
+
+    def backlink_map(self):
+        """
+        Backlinks for every note at once, as a dict of note id to a list of
+        WikiLinks - for exporters, which want them all.
+        """
+        with self._lock:
+            links = self._links('r.dest IS NOT NULL', [])
+        backlinks = {}
+        for link in links:
+            backlinks.setdefault(link.id, []).append(link)
+        return {id: _by_source(links) for id, links in backlinks.items()}
+
+
+def _by_source(links):
+    # A note can link to another more than once, say to different headings,
+    # but it's only one backlink
+    seen = set()
+    return [l for l in links if not (l.source in seen or seen.add(l.source))]
@@ -0,0 +1,275 @@
+#
+# Copyright (c) 2020  Richard Clark
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+"""
+Keeps track of what an exporter wrote last time, so re-running it only
+touches the notes and images that actually changed. The manifest lives in the
+output directory as a small JSON file.
+"""
+import hashlib
+import json
+import os
+import os.path
+
+from .assets import AssetCopier
+
+
+class ExportManifest(object):
+    """
+    Use it like this from an exporter:
+
+        manifest = ExportManifest(output_dir, 'myexporter', config = 'some settings')
+        for note in notes:
+            manifest.export_note(note, filename, lambda: render(note))
+        report = manifest.finish()
+
+    `name` identifies the exporter, so two exporters sharing an output
+    directory don't clean up each other's files. `config` should describe
+    anything other than the note that affects the output (templates,
+    stylesheets, options). If it differs from last time every note is
+    rendered again. With force every note, image and file is written again
+    whatever the last run recorded, in case the output was changed by hand.
+
+    Images are handed to copier, an AssetCopier, which copies them in the
+    background; finish() waits for it. By default one is made with the
+    default settings.
+    """
+    FILENAME = '.pybear-{}-manifest.json'
+    VERSION = 1
+
+    def __init__(self, output_dir, name, config = None, force = False,
+            copier = None):
+        self._dir = output_dir
+        self._path = os.path.join(output_dir, self.FILENAME.format(name))
+
+        old = {}
+        if os.path.exists(self._path):
+            with open(self._path, 'r', encoding = 'utf8') as f:
+                old = json.load(f)
+            if old.get('version') != self.VERSION:
+                old = {}
+        self._old_notes = old.get('notes', {})
+        self._old_images = old.get('images', {})
+        self._old_files = old.get('files', {})
+        self._force = force
+        self._reuse = not force and old.get('config') == config
+
+        self._config = config
+        self._copier = copier or AssetCopier()
+        self._notes = {}
+        self._images = {}
+        self._files = {}
+        self.report = {
+            'written': [],
+            'unchanged': 0,
+            'renamed': [],
+            'deleted': [],
+            'images_copied': 0,
+            'images_unchanged': 0,
+            'images_deleted': 0,
+        }
+
+    def _full(self, relpath):
+        return os.path.join(self._dir, relpath)
+
+    def export_note(self, note, filename, render, depends = None):
+        """
+        Write the note to filename (relative to the output dir) unless it's
+        unchanged since the last run. render is only called when the note does
+        need writing and must return the file content as a string. The note's
+        images are copied too.
+
+        depends is a string describing anything else this note's output is
+        made from (other notes' titles, say); if it changes the note is
+        rewritten.
+        """
+        if not self.check_note(note, filename, depends):
+            return False
+        self.write_note(note, filename, render(), depends)
+        return True
+
+    def check_note(self, note, filename, depends = None):
+        """
+        Does the note need writing? If not it's recorded as unchanged (and its
+        images checked) and there's nothing more to do for it. If so, follow up
+        with write_note().
+        """
+        old = self._old_notes.get(note.id)
+        if self._reuse and old and old['modified'] == _modified(note) \
+                and old.get('depends') == depends \
+                and old['filename'] == filename \
+                and os.path.exists(self._full(filename)):
+            self._notes[note.id] = old
+            self.report['unchanged'] += 1
+            for uri in old['images']:
+                self.copy_image(note._bear.image(uri))
+            return False
+        return True
+
+    def write_note(self, note, filename, content, depends = None):
+        """
+        Write the rendered note and copy its images.
+        """
+        old = self._old_notes.get(note.id)
+        data = content.encode('utf8')
+        digest = hashlib.sha1(data).hexdigest()
+        path = self._full(filename)
+
+        # Don't touch the file if its content came out the same, that way its
+        # mtime doesn't change either. Unless forced: the file may have been
+        # changed since, and the old hash says nothing about that.
+        if self._force or not (old and old['hash'] == digest and old['filename'] == filename
+                and os.path.exists(path)):
+            # Encoded once, written in one go
+            with open(path, 'wb') as f:
+                f.write(data)
+            self.report['written'].append(filename)
+        else:
+            self.report['unchanged'] += 1
+
+        if old and old['filename'] != filename:
+            self.report['renamed'].append((old['filename'], filename))
+
+        images = []
+        for image in note.images():
+            if self.copy_image(image) is not None:
+                images.append(image.uri)
+
+        self._notes[note.id] = {
+            'modified': _modified(note),
+            'filename': filename,
+            'hash': digest,
+            'images': images,
+            'depends': depends,
+        }
+
+    def add_bytes(self, name, data, mtime = None):
+        """
+        Write a file that isn't a note (a stylesheet, say) to name, relative
+        to the output dir, unless it's already there as it was last time.
+        It's recorded, so if a later run doesn't add it again it's removed.
+        mtime is ignored, it's there to match ArchiveExport.
+        """
+        digest = hashlib.sha1(data).hexdigest()
+        path = self._full(name)
+        if self._force or not (self._old_files.get(name) == digest
+                               and os.path.exists(path)):
+            with open(path, 'wb') as f:
+                f.write(data)
+        self._files[name] = digest
+
+    def copy_image(self, image):
+        """
+        Copy an image into the output dir under its uri, unless an identical
+        copy is already there. Returns the target path, or None if the image
+        doesn't exist.
+        """
+        if image.uri in self._images:
+            return self._full(image.uri)
+        if not image.exists():
+            return None
+
+        stat = os.stat(image.path)
+        source = [stat.st_size, stat.st_mtime_ns]
+        target = self._full(image.uri)
+
+        if self._images_unchanged(image.uri, source, target):
+            self.report['images_unchanged'] += 1
+        else:
+            self._copier.submit(image.path, target)
+            self.report['images_copied'] += 1
+
+        self._images[image.uri] = source
+        return target
+
+    def _images_unchanged(self, uri, source, target):
+        if self._force or self._old_images.get(uri) != source:
+            return False
+        try:
+            return os.path.getsize(target) == source[0]
+        except OSError:
+            return False
+
+    def finish(self):
+        """
+        Wait for the images to be copied, remove the output of notes, images
+        and other files that are gone (or were renamed), save the manifest
+        and return the report.
+        """
+        self.report['images_by_method'] = self._copier.wait()
+        self._copier.close()
+
+        keep = {entry['filename'] for entry in self._notes.values()}
+        for id, entry in self._old_notes.items():
+            filename = entry['filename']
+            if filename in keep:
+                continue
+            keep.add(filename)
+            if os.path.exists(self._full(filename)):
+                os.remove(self._full(filename))
+            if id not in self._notes:
+                self.report['deleted'].append(filename)
+
+        for uri in self._old_images:
+            if uri in self._images:
+                continue
+            target = self._full(uri)
+            if os.path.exists(target):
+                os.remove(target)
+                self.report['images_deleted'] += 1
+                # Bear keeps each note's images in their own directory
+                try:
+                    os.rmdir(os.path.dirname(target))
+                except OSError:
+                    pass
+
+        for name in self._old_files:
+            if name not in self._files and os.path.exists(self._full(name)):
+                os.remove(self._full(name))
+
+        tmp = self._path + '.tmp'
+        with open(tmp, 'w', encoding = 'utf8') as f:
+            json.dump({
+                'version': self.VERSION,
+                'config': self._config,
+                'notes': self._notes,
+                'images': self._images,
+                'files': self._files,
+            }, f)
+        os.replace(tmp, self._path)
+
+        return self.report
+
+    def summary(self):
+        r = self.report
+        return ('{} notes written, {} unchanged, {} renamed, {} deleted; '
+                '{} images copied, {} unchanged, {} deleted').format(
+            len(r['written']), r['unchanged'], len(r['renamed']),
+            len(r['deleted']), r['images_copied'], r['images_unchanged'],
+            r['images_deleted']) + ''.join(
+            ' ({} {})'.format(n, method)
+            for method, n in sorted(r.get('images_by_method', {}).items()))
+
+
+def _modified(note):
+    return note.modified.isoformat() if note.modified else None
+
@@ -0,0 +1,114 @@
+#
+# Copyright (c) 2020  Richard Clark
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+"""
+Picks apart Bear's markup: images, file attachments, #tags, todos, headings
+and links, in a single pass over the text. Anything in code blocks or inline
+code is left alone, as it is in Bear.
+
+    summary = parse(note.text)
+    for todo in summary.todos:
+        print('[x]' if todo.checked else '[ ]', todo.text)
+"""
+import collections
+import re
+
+
+Todo = collections.namedtuple('Todo', 'text checked line')
+Heading = collections.namedtuple('Heading', 'level text line')
+# kind is 'wiki' for [[Note Title]], 'markdown' for [text](url) and 'url'
+# for bare URLs; text is None where there isn't any.
+Link = collections.namedtuple('Link', 'kind target text')
+
+
+# One alternative per kind of token. Headings and todos only consume their
+# prefix, and look ahead for the rest of the line, so the images, tags and
+# links in them are still found. Code is matched so it can be skipped.
+TOKEN_RE = re.compile(r'''
+    (?P<fence>^[ \t]*(?P<fence_mark>```|~~~)[^\n]*\n(?:.*?\n)??[ \t]*(?P=fence_mark)[ \t]*$)
+  | (?P<code>`[^`\n]+`)
+  | (?P<heading>^(?P<heading_level>\#{1,6})[ \t]+(?=(?P<heading_text>[^\n]*?)[ \t]*$))
+  | (?P<todo>^[ \t]*[-*+][ \t]+\[(?P<todo_mark>[ xX])\][ \t]+(?=(?P<todo_text>[^\n]*)))
+  | \[image:(?P<image>[^\]\n]+)\]
+  | \[file:(?P<file>[^\]\n]+)\]
+  | \[\[(?P<wiki>[^\]\n]+)\]\]
+  | \[(?P<md_text>[^\]\n]*)\]\((?P<md_url>[^)\s]+)(?:[ \t]+"[^"\n]*")?\)
+  | (?P<url>\bhttps?://[^\s<>()\[\]]+[^\s<>()\[\].,;:!?'"])
+  | (?:(?<=\s)|(?<=^))\#(?P<multi_tag>[^\s\#](?:[^\#\n]*?[^\s\#])?)\#(?=\s|$|[.,;:!?)])
+  | (?:(?<=\s)|(?<=^))\#(?P<tag>[^\s\#\[\](){}<>,;:!?"']+)
+''', re.MULTILINE | re.DOTALL | re.VERBOSE)
+
+
+class NoteSummary(object):
+    """
+    What parse() found, in the order it appears in the text. tags are the
+    inline tags as written, without the '#' and with duplicates removed.
+    """
+    __slots__ = ('images', 'files', 'tags', 'todos', 'headings', 'links')
+
+    def __init__(self):
+        self.images = []
+        self.files = []
+        self.tags = []
+        self.todos = []
+        self.headings = []
+        self.links = []
+
+
+def parse(text):
+    summary = NoteSummary()
+    if not text:
+        return summary
+
+    seen_tags = set()
+    line = 1
+    last = 0
+    for m in TOKEN_RE.finditer(text):
+        kind = m.lastgroup
+        if kind in ('fence', 'code'):
+            continue
+        line += text.count('\n', last, m.start())
+        last = m.start()
+
+        if kind == 'heading':
+            summary.headings.append(Heading(
+                len(m.group('heading_level')), m.group('heading_text'), line))
+        elif kind == 'todo':
+            summary.todos.append(Todo(
+                m.group('todo_text'), m.group('todo_mark') != ' ', line))
+        elif kind == 'image':
+            summary.images.append(m.group('image'))
+        elif kind == 'file':
+            summary.files.append(m.group('file'))
+        elif kind == 'wiki':
+            summary.links.append(Link('wiki', m.group('wiki'), None))
+        elif kind == 'md_url':
+            summary.links.append(Link('markdown', m.group('md_url'),
+                                      m.group('md_text')))
+        elif kind == 'url':
+            summary.links.append(Link('url', m.group('url'), None))
+        elif kind in ('tag', 'multi_tag'):
+            tag = m.group(kind).rstrip('.')
+            if tag and tag not in seen_tags:
+                seen_tags.add(tag)
+                summary.tags.append(tag)
+    return summary
@@ -0,0 +1,200 @@
+#
+# Copyright (c) 2020  Richard Clark
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+"""
+Connections to the Bear database. Bear itself has the database open while we
+read it, so by default we open it read only, and for multi-threaded use we
+hand each thread its own connection from a pool.
+"""
+import contextlib
+import queue
+import sqlite3
+import threading
+import urllib.parse
+
+
+# Applied to read only connections, on top of anything the caller passes.
+# query_only is belt and braces on top of mode=ro; the rest trades a bit of
+# memory for fewer reads, since the database is only going to be scanned.
+READ_ONLY_PRAGMAS = {
+    'query_only': 1,
+    'mmap_size': 256 * 1024 * 1024,
+    'cache_size': -32 * 1024,
+}
+
+
+def open_connection(path, read_only = False, immutable = False,
+        pragmas = None, **kwds):
+    """
+    Open a connection to the database at path.
+
+    read_only opens it with mode=ro, which can't write to the database (or
+    Bear's WAL) under any circumstances. immutable additionally tells SQLite
+    the file can't change at all, so it skips locking entirely - only use that
+    on a copy or snapshot, never on the database Bear is using.
+    """
+    if read_only or immutable:
+        params = {'mode': 'ro'}
+        if immutable:
+            params['immutable'] = 1
+        uri = 'file:{}?{}'.format(
+            urllib.parse.quote(path), urllib.parse.urlencode(params))
+        db = sqlite3.connect(uri, uri = True, **kwds)
+        all_pragmas = dict(READ_ONLY_PRAGMAS)
+    else:
+        db = sqlite3.connect(path, **kwds)
+        all_pragmas = {}
+
+    all_pragmas.update(pragmas or {})
+    for name, value in all_pragmas.items():
+        db.execute('PRAGMA {} = {}'.format(name, int(value)))
+
+    db.row_factory = sqlite3.Row
+    return db
+
+
+class DataVersion(object):
+    """
+    Has anything been committed to the database since we last asked? That's
+    SQLite's data_version, which is only meaningful asked of the same
+    connection every time, so this keeps one of its own, opened on first use.
+    Asking doesn't touch the disk, so it's cheap enough to do often.
+    """
+    def __init__(self, path):
+        self._path = path
+        self._db = None
+        self._version = None
+        self._lock = threading.Lock()
+
+    def changed(self):
+        """
+        True if the database has changed since the last call. The first call
+        only takes note of where things are, and returns False.
+        """
+        with self._lock:
+            if self._db is None:
+                self._db = open_connection(self._path, read_only = True,
+                    check_same_thread = False)
+            version = self._db.execute('PRAGMA data_version').fetchone()[0]
+            changed = self._version is not None and version != self._version
+            self._version = version
+            return changed
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+                self._version = None
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool(object):
+    """
+    Up to `size` connections, opened as they're needed. acquire() blocks
+    (for up to `timeout` seconds) when they're all checked out.
+
+    Connections are opened with check_same_thread off so they can be handed
+    between threads, but only one thread uses a connection at a time.
+    on_connect, if given, is called with each new connection.
+    """
+    def __init__(self, path, size = 4, timeout = 30, on_connect = None,
+            **kwds):
+        self._path = path
+        self._on_connect = on_connect
+        self._size = size
+        self._timeout = timeout
+        self._kwds = kwds
+        self._kwds['check_same_thread'] = False
+        self._idle = queue.LifoQueue()
+        self._opened = 0
+        self._lock = threading.Lock()
+
+    @property
+    def size(self):
+        return self._size
+
+    def acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            if self._opened < self._size:
+                self._opened += 1
+                open_new = True
+            else:
+                open_new = False
+        if open_new:
+            try:
+                return self.open()
+            except Exception:
+                with self._lock:
+                    self._opened -= 1
+                raise
+
+        try:
+            return self._idle.get(timeout = self._timeout)
+        except queue.Empty:
+            raise PoolTimeout(
+                'No database connection free after {}s (pool size {})'.format(
+                    self._timeout, self._size))
+
+    def open(self):
+        """
+        A new connection with the pool's settings, which isn't counted
+        against its size and never goes into it; close it when done. For
+        work that holds on to a connection for a long time, like a stream
+        of notes, and shouldn't starve everything else.
+        """
+        db = open_connection(self._path, **self._kwds)
+        if self._on_connect is not None:
+            self._on_connect(db)
+        return db
+
+    def release(self, db):
+        # Don't hand on a connection that's still inside a transaction
+        if db.in_transaction:
+            db.rollback()
+        self._idle.put(db)
+
+    @contextlib.contextmanager
+    def connection(self):
+        db = self.acquire()
+        try:
+            yield db
+        finally:
+            self.release(db)
+
+    def close(self):
+        while True:
+            try:
+                db = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            db.close()
+            with self._lock:
+                self._opened -= 1
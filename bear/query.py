@@ -0,0 +1,264 @@
+#
+# Copyright (c) 2020  Richard Clark
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+"""
+Building note queries that run as a single SQL statement, instead of loading
+notes and filtering them in Python.
+
+    notes = b.query() \
+        .any_tag('public', 'posts') \
+        .modified_since(datetime.datetime(2020, 1, 1)) \
+        .trashed(False) \
+        .order_by('modified', desc = True) \
+        .limit(20)
+
+    for note in notes:
+        print(note.title)
+"""
+import datetime
+
+
+ORDER_FIELDS = {
+    'created': 'ZSFNOTE.ZCREATIONDATE',
+    'modified': 'ZSFNOTE.ZMODIFICATIONDATE',
+    'archived': 'ZSFNOTE.ZARCHIVEDDATE',
+    'trashed': 'ZSFNOTE.ZTRASHEDDATE',
+    'title': 'ZSFNOTE.ZTITLE',
+    'pinned': 'ZSFNOTE.ZPINNED',
+    'id': 'ZSFNOTE.Z_PK',
+}
+
+
+def _timestamp(value):
+    # Dates can be given as datetimes, dates (meaning midnight at the start
+    # of them) or raw Core Data timestamps. Anything else would be compared
+    # as text by SQLite, and quietly match everything or nothing.
+    from . import datetime_to_timestamp
+    if isinstance(value, datetime.datetime):
+        return datetime_to_timestamp(value)
+    if isinstance(value, datetime.date):
+        return datetime_to_timestamp(
+            datetime.datetime.combine(value, datetime.time()))
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return value
+    raise TypeError('Expected a datetime, date or timestamp, not {!r}'.format(
+        value))
+
+
+class NoteQuery(object):
+    """
+    Made by Bear.query(). Every method adds to the query and returns it, so
+    they can be chained; nothing runs until you iterate over it (or call
+    count() or first()).
+
+    Tag filters match the tag and, with subtree=True (the default),
+    everything below it: any_tag('work') matches '#work/meetings' too. Bear
+    tags are case sensitive and so are these.
+    """
+    def __init__(self, bear):
+        self._bear = bear
+        self._where = []
+        self._params = []
+        self._order = []
+        self._limit = None
+        self._offset = None
+        self._lazy = False
+        self._prefetch_tags = False
+
+    def _tag_condition(self, alias, titles, subtree):
+        """
+        SQL matching ZSFNOTETAG rows (as alias) against the titles.
+        """
+        conditions = []
+        params = []
+        for title in titles:
+            if subtree:
+                # Not LIKE, that's case insensitive and treats _ specially
+                conditions.append(
+                    '({0}.ZTITLE = ? OR substr({0}.ZTITLE, 1, ?) = ?)'.format(
+                        alias))
+                params.extend([title, len(title) + 1, title + '/'])
+            else:
+                conditions.append('{}.ZTITLE = ?'.format(alias))
+                params.append(title)
+        return '(' + ' OR '.join(conditions) + ')', params
+
+    def _has_tag(self, titles, subtree):
+        # A semi-join rather than a JOIN, so a note with several matching
+        # tags still comes out once and the query doesn't need DISTINCT
+        condition, params = self._tag_condition('g', titles, subtree)
+        self._filter('''ZSFNOTE.Z_PK IN (
+            SELECT t.Z_7NOTES FROM Z_7TAGS t JOIN ZSFNOTETAG g ON g.Z_PK = t.Z_14TAGS
+            WHERE {})'''.format(condition), *params)
+
+    def any_tag(self, *titles, subtree = True):
+        """
+        Notes with at least one of the tags.
+        """
+        if titles:
+            self._has_tag(titles, subtree)
+        return self
+
+    def all_tags(self, *titles, subtree = True):
+        """
+        Notes with every one of the tags.
+        """
+        for title in titles:
+            self._has_tag([title], subtree)
+        return self
+
+    def without_tags(self, *titles, subtree = True):
+        """
+        Notes with none of the tags.
+        """
+        if titles:
+            condition, params = self._tag_condition('g', titles, subtree)
+            self._where.append('''NOT EXISTS (
+                SELECT 1 FROM Z_7TAGS t JOIN ZSFNOTETAG g ON g.Z_PK = t.Z_14TAGS
+                WHERE t.Z_7NOTES = ZSFNOTE.Z_PK AND {})'''.format(condition))
+            self._params.extend(params)
+        return self
+
+    def _filter(self, condition, *params):
+        self._where.append(condition)
+        self._params.extend(params)
+        return self
+
+    def modified_since(self, when):
+        return self._filter('ZSFNOTE.ZMODIFICATIONDATE > ?', _timestamp(when))
+
+    def modified_before(self, when):
+        return self._filter('ZSFNOTE.ZMODIFICATIONDATE < ?', _timestamp(when))
+
+    def created_between(self, start = None, end = None):
+        """
+        Notes created at or after start and before end, either of which can
+        be None for no limit.
+        """
+        if start is not None:
+            self._filter('ZSFNOTE.ZCREATIONDATE >= ?', _timestamp(start))
+        if end is not None:
+            self._filter('ZSFNOTE.ZCREATIONDATE < ?', _timestamp(end))
+        return self
+
+    def _flag(self, column, value):
+        return self._filter('ZSFNOTE.{} {} 0'.format(
+            column, '!=' if value else '='))
+
+    def pinned(self, value = True):
+        return self._flag('ZPINNED', value)
+
+    def archived(self, value = True):
+        return self._flag('ZARCHIVED', value)
+
+    def trashed(self, value = True):
+        return self._flag('ZTRASHED', value)
+
+    def deleted(self, value = True):
+        return self._flag('ZPERMANENTLYDELETED', value)
+
+    def order_by(self, field, desc = False):
+        """
+        Sort by one of ORDER_FIELDS ('created', 'modified', 'title', ...).
+        Call it again to add tie breakers.
+        """
+        if field not in ORDER_FIELDS:
+            raise ValueError('Can not order notes by {!r}, try one of {}'.format(
+                field, ', '.join(sorted(ORDER_FIELDS))))
+        self._order.append(ORDER_FIELDS[field] + (' DESC' if desc else ''))
+        return self
+
+    def limit(self, n):
+        self._limit = n
+        return self
+
+    def offset(self, n):
+        self._offset = n
+        return self
+
+    def lazy(self, value = True):
+        """
+        Don't select the note text, see Bear.notes().
+        """
+        self._lazy = value
+        return self
+
+    def prefetch_tags(self, value = True):
+        """
+        Load every note's tags in one query, see Bear.notes().
+        """
+        self._prefetch_tags = value
+        return self
+
+    def _from_where(self):
+        sql = 'FROM ZSFNOTE'
+        if self._where:
+            sql += ' WHERE ' + ' AND '.join(self._where)
+        return sql, list(self._params)
+
+    def _sql(self, limit):
+        from_where, params = self._from_where()
+        sql = 'SELECT {} {}'.format(
+            self._bear._note_columns(self._lazy), from_where)
+        if self._order:
+            sql += ' ORDER BY ' + ', '.join(self._order)
+        if limit is not None or self._offset is not None:
+            sql += ' LIMIT ?'
+            params.append(limit if limit is not None else -1)
+            if self._offset is not None:
+                sql += ' OFFSET ?'
+                params.append(self._offset)
+        return sql, params
+
+    def sql(self):
+        """
+        The SQL statement and parameters this query will run.
+        """
+        return self._sql(self._limit)
+
+    def _iter(self, limit):
+        sql, params = self._sql(limit)
+        cursor = self._bear._cursor('NoteQuery')
+        cursor.execute(sql, params)
+        tag_map = self._bear._note_tag_map() if self._prefetch_tags else None
+        return self._bear._iter_notes(cursor, tag_map, self._lazy)
+
+    def __iter__(self):
+        return self._iter(self._limit)
+
+    def first(self):
+        """
+        The first matching note, or None. Doesn't change the query's limit.
+        """
+        limit = 1 if self._limit is None else min(self._limit, 1)
+        for note in self._iter(limit):
+            return note
+        return None
+
+    def count(self):
+        """
+        How many notes match, ignoring limit and offset.
+        """
+        from_where, params = self._from_where()
+        cursor = self._bear._cursor('NoteQuery.count')
+        cursor.execute('SELECT COUNT(*) ' + from_where, params)
+        return cursor.fetchone()[0]
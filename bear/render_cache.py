@@ -0,0 +1,183 @@
+#
+# Copyright (c) 2020  Richard Clark
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+"""
+A cache of rendered notes, so unchanged notes don't go through the markdown
+renderer again. Entries are keyed by a hash of the note text and of whatever
+describes the renderer (its version, extensions and so on), which means
+there's nothing to invalidate: change either and the key changes. Old
+entries are evicted least recently used first once the cache outgrows its
+size limit.
+"""
+import hashlib
+import sqlite3
+import threading
+import time
+
+
+class RenderCache(object):
+    """
+    Stored in a small SQLite file, which can be shared between processes.
+    max_bytes bounds the total size of the cached output.
+    """
+
+    # Hits are recorded in memory and written out in batches
+    TOUCH_BATCH = 200
+
+    def __init__(self, path, max_bytes = 256 * 1024 * 1024):
+        self._path = path
+        self.max_bytes = max_bytes
+        self._db = sqlite3.connect(path, timeout = 30,
+                                   check_same_thread = False)
+        self._lock = threading.Lock()
+        self._db.execute('PRAGMA journal_mode = WAL')
+        self._db.executescript('''
+            CREATE TABLE IF NOT EXISTS render (
+                key         VARCHAR PRIMARY KEY,
+                output      VARCHAR,
+                size        INTEGER,
+                last_used   REAL
+            );
+            CREATE INDEX IF NOT EXISTS render_last_used ON render (last_used);
+            CREATE TABLE IF NOT EXISTS counter (
+                name        VARCHAR PRIMARY KEY,
+                value       INTEGER
+            );
+        ''')
+        self._total = self._db.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM render').fetchone()[0]
+        self._touched = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # The counts as of the last time they were added to the stored totals
+        self._saved = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    @staticmethod
+    def key(text, config):
+        """
+        The cache key for text rendered with config, a string describing the
+        renderer.
+        """
+        h = hashlib.sha256(config.encode('utf8'))
+        h.update(b'\0')
+        h.update(text.encode('utf8'))
+        return h.hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            row = self._db.execute(
+                'SELECT output FROM render WHERE key = ?', [key]).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._touched[key] = time.time()
+            if len(self._touched) >= self.TOUCH_BATCH:
+                self._flush()
+            return row[0]
+
+    def put(self, key, output):
+        size = len(output.encode('utf8'))
+        with self._lock:
+            with self._db:
+                old = self._db.execute('SELECT size FROM render WHERE key = ?',
+                                       [key]).fetchone()
+                self._db.execute(
+                    'INSERT OR REPLACE INTO render VALUES (?, ?, ?, ?)',
+                    [key, output, size, time.time()])
+            self._total += size - (old[0] if old else 0)
+            if self._total > self.max_bytes:
+                self._evict()
+
+    def get_or_render(self, text, config, render):
+        """
+        The cached output for text, or render(text), which is then cached.
+        """
+        key = self.key(text, config)
+        output = self.get(key)
+        if output is None:
+            output = render(text)
+            self.put(key, output)
+        return output
+
+    def _flush(self):
+        if self._touched:
+            with self._db:
+                self._db.executemany(
+                    'UPDATE render SET last_used = ? WHERE key = ?',
+                    [(t, k) for k, t in self._touched.items()])
+            self._touched = {}
+
+    def _evict(self):
+        # Down to 90% of the limit, so we're not evicting on every put
+        self._flush()
+        target = self.max_bytes * 0.9
+        evicted = []
+        cursor = self._db.execute(
+            'SELECT key, size FROM render ORDER BY last_used')
+        for key, size in cursor:
+            if self._total <= target:
+                break
+            evicted.append((key,))
+            self._total -= size
+        cursor.close()
+        with self._db:
+            self._db.executemany('DELETE FROM render WHERE key = ?', evicted)
+        self.evictions += len(evicted)
+
+    def stats(self):
+        """
+        Hits, misses and evictions since this was opened and in total, plus
+        the number and size of the entries.
+        """
+        with self._lock:
+            self._save_counters()
+            totals = dict(self._db.execute('SELECT name, value FROM counter'))
+            entries = self._db.execute('SELECT COUNT(*) FROM render').fetchone()[0]
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'total_hits': totals.get('hits', 0),
+            'total_misses': totals.get('misses', 0),
+            'total_evictions': totals.get('evictions', 0),
+            'entries': entries,
+            'bytes': self._total,
+        }
+
+    def _save_counters(self):
+        # Add what we've counted since last time to the stored totals
+        self._flush()
+        with self._db:
+            for name in self._saved:
+                delta = getattr(self, name) - self._saved[name]
+                self._db.execute('''
+                    INSERT INTO counter VALUES (?, ?)
+                    ON CONFLICT (name) DO UPDATE SET value = value + ?
+                ''', [name, delta, delta])
+        self._saved = {n: getattr(self, n) for n in self._saved}
+
+    def close(self):
+        with self._lock:
+            self._save_counters()
+            self._db.close()
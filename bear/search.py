@@ -0,0 +1,193 @@
+#
+# Copyright (c) 2020  Richard Clark
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+"""
+Full text search over note titles and text, using an SQLite FTS5 index kept
+in a separate file. Bear's own database is only ever read.
+"""
+import sqlite3
+import threading
+
+
+def plain_query(text):
+    """
+    An FTS5 query matching notes with all the words in text, each quoted so
+    that punctuation and keywords in it (-, :, *, AND, ...) mean nothing.
+    """
+    return ' '.join('"{}"'.format(word.replace('"', '""'))
+                    for word in text.split())
+
+
+def note_changes(bear, db, table, columns, name):
+    """
+    What a sidecar index needs to do to catch up with Bear. table, in db, has
+    a Z_PK and ZMODIFICATIONDATE for every note the index holds; they're
+    compared with the notes that aren't trashed or deleted. Returns
+    (changed, removed): changed yields the ZSFNOTE rows (just columns) of
+    the notes that are new or modified since, removed is a list of the Z_PKs
+    of the notes that are gone. name labels the queries in Bear.stats().
+    """
+    indexed = dict(db.execute(
+        'SELECT Z_PK, ZMODIFICATIONDATE FROM {}'.format(table)))
+
+    cursor = bear._cursor(name)
+    cursor.execute('''
+        SELECT Z_PK, ZMODIFICATIONDATE FROM ZSFNOTE
+        WHERE ZTRASHED = 0 AND ZPERMANENTLYDELETED = 0
+    ''')
+    stale = []
+    live = set()
+    for pk, modified in cursor.fetchall():
+        live.add(pk)
+        if pk not in indexed or (modified or 0) > (indexed[pk] or 0):
+            stale.append(pk)
+    removed = [pk for pk in indexed if pk not in live]
+
+    def changed():
+        # A few hundred at a time, to stay well under SQLite's limit on
+        # parameters
+        for i in range(0, len(stale), 500):
+            batch = stale[i:i + 500]
+            cursor.execute('SELECT {} FROM ZSFNOTE WHERE Z_PK IN ({})'.format(
+                columns, ', '.join('?' * len(batch))), batch)
+            yield from cursor.fetchall()
+
+    return changed(), removed
+
+
+class SearchResult(object):
+    def __init__(self, bear, id, title, snippet, rank):
+        self._bear = bear
+        self.id = id
+        self.title = title
+        self.snippet = snippet
+        self.rank = rank
+
+    def note(self):
+        return self._bear.get_note(self.id)
+
+    def __str__(self):
+        return "({}) {}: {}".format(self.id, self.title, self.snippet)
+
+
+class SearchIndex(object):
+    """
+    The index remembers the modification date of every note it holds, so
+    refresh() only reindexes notes that changed since last time and drops
+    notes that were trashed or deleted.
+    """
+
+    # Title matches count for more than body matches.
+    TITLE_WEIGHT = 10.0
+    TEXT_WEIGHT = 1.0
+
+    def __init__(self, bear, path):
+        self._bear = bear
+        self._path = path
+        # The index can be used from several threads (see Bear.connect()
+        # and AsyncBear), one at a time.
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._db.executescript('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS note_fts USING fts5(
+                title, text, tokenize = 'unicode61 remove_diacritics 2'
+            );
+            CREATE TABLE IF NOT EXISTS note_meta (
+                Z_PK                INTEGER PRIMARY KEY,
+                ZUNIQUEIDENTIFIER   VARCHAR,
+                ZMODIFICATIONDATE   TIMESTAMP
+            );
+        ''')
+
+    def close(self):
+        self._db.close()
+
+    def refresh(self):
+        """
+        Bring the index up to date with the Bear database. Returns a tuple of
+        (notes indexed, notes removed).
+        """
+        with self._lock:
+            return self._refresh()
+
+    def _refresh(self):
+        changed, removed = note_changes(self._bear, self._db, 'note_meta',
+            'Z_PK, ZUNIQUEIDENTIFIER, ZMODIFICATIONDATE, ZTITLE, ZTEXT',
+            'SearchIndex.refresh')
+        indexed = 0
+        with self._db:
+            for pk in removed:
+                self._delete(pk)
+
+            for row in changed:
+                self._delete(row['Z_PK'])
+                self._db.execute(
+                    'INSERT INTO note_fts (rowid, title, text) '
+                    'VALUES (?, ?, ?)',
+                    [row['Z_PK'], row['ZTITLE'] or '', row['ZTEXT'] or ''])
+                self._db.execute(
+                    'INSERT INTO note_meta VALUES (?, ?, ?)',
+                    [row['Z_PK'], row['ZUNIQUEIDENTIFIER'],
+                     row['ZMODIFICATIONDATE']])
+                indexed += 1
+
+        return indexed, len(removed)
+
+    def _delete(self, pk):
+        self._db.execute('DELETE FROM note_fts WHERE rowid = ?', [pk])
+        self._db.execute('DELETE FROM note_meta WHERE Z_PK = ?', [pk])
+
+    def search(self, query, limit=20, plain=False):
+        """
+        Run an FTS5 query (e.g. 'cats', '"exact phrase"', 'title:cats',
+        'cat*') and return the best matches first.
+
+        With plain=True the query is just words to look for, and nothing in
+        it is FTS5 syntax. A query FTS5 can't make sense of (like 'e-mail' or
+        'C++', typed into a search box) is searched for as plain words too.
+        """
+        with self._lock:
+            if not plain:
+                try:
+                    return self._search(query, limit)
+                except sqlite3.OperationalError:
+                    pass
+            query = plain_query(query)
+            # Nothing to look for (FTS5 won't take an empty query)
+            if not query:
+                return []
+            return self._search(query, limit)
+
+    def _search(self, query, limit):
+        cursor = self._db.execute('''
+            SELECT note_meta.ZUNIQUEIDENTIFIER, note_fts.title,
+                snippet(note_fts, 1, '[', ']', '...', 12),
+                bm25(note_fts, ?, ?) AS rank
+            FROM note_fts
+            JOIN note_meta ON note_meta.Z_PK = note_fts.rowid
+            WHERE note_fts MATCH ?
+            ORDER BY rank
+            LIMIT ?
+        ''', [self.TITLE_WEIGHT, self.TEXT_WEIGHT, query, limit])
+
+        return [SearchResult(self._bear, id, title, snippet, rank)
+                for id, title, snippet, rank in cursor.fetchall()]
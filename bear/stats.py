@@ -0,0 +1,214 @@
+#
+# Copyright (c) 2020  Richard Clark
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+"""
+Optional instrumentation of the queries pybear runs: how many, from where,
+how many rows they returned and how long they took. Turn it on with
+Bear(instrument=True) and read it back with Bear.stats().
+"""
+import logging
+import threading
+import time
+
+
+log = logging.getLogger('bear')
+
+# Upper bounds, in seconds, of the latency histogram buckets. Anything slower
+# than the last goes in a final overflow bucket.
+BUCKETS = [0.0001, 0.001, 0.01, 0.1, 1.0]
+
+# How many slow queries to remember
+SLOW_QUERY_LOG_SIZE = 50
+
+
+def _bucket_label(i):
+    if i == len(BUCKETS):
+        return '>{}ms'.format(BUCKETS[-1] * 1000)
+    return '<{}ms'.format(BUCKETS[i] * 1000)
+
+
+class QueryStats(object):
+    """
+    Counters, shared by every connection of a Bear. slow_query is a time in
+    seconds; queries taking longer are logged (to the 'bear' logger, at
+    WARNING) and kept in the snapshot.
+    """
+    def __init__(self, slow_query = 0.5):
+        self.slow_query = slow_query
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._sites = {}
+            self._statements = {}
+            self._slow = []
+
+    def trace(self, sql):
+        """
+        sqlite3 trace callback: counts every statement run on the
+        connection, whether it came through a TimedCursor or not.
+        """
+        kind = sql.lstrip().split(None, 1)[0].upper() if sql.strip() else ''
+        with self._lock:
+            self._statements[kind] = self._statements.get(kind, 0) + 1
+
+    def record(self, site, sql, seconds, rows):
+        bucket = 0
+        while bucket < len(BUCKETS) and seconds > BUCKETS[bucket]:
+            bucket += 1
+
+        with self._lock:
+            s = self._sites.get(site)
+            if s is None:
+                s = self._sites[site] = {
+                    'queries': 0,
+                    'rows': 0,
+                    'seconds': 0.0,
+                    'max_seconds': 0.0,
+                    'histogram': [0] * (len(BUCKETS) + 1),
+                }
+            s['queries'] += 1
+            s['rows'] += rows
+            s['seconds'] += seconds
+            s['max_seconds'] = max(s['max_seconds'], seconds)
+            s['histogram'][bucket] += 1
+
+            slow = self.slow_query is not None and seconds >= self.slow_query
+            if slow:
+                self._slow.append({
+                    'site': site,
+                    'sql': ' '.join(sql.split()),
+                    'seconds': seconds,
+                    'rows': rows,
+                })
+                del self._slow[:-SLOW_QUERY_LOG_SIZE]
+
+        if slow:
+            log.warning('Slow query from %s (%.3fs, %d rows): %s',
+                        site, seconds, rows, ' '.join(sql.split()))
+
+    def snapshot(self):
+        """
+        A copy of the counters as plain dicts and lists.
+        """
+        with self._lock:
+            sites = {}
+            for site, s in self._sites.items():
+                s = dict(s)
+                s['histogram'] = {_bucket_label(i): n
+                                  for i, n in enumerate(s['histogram'])}
+                sites[site] = s
+            return {
+                'queries': sum(s['queries'] for s in sites.values()),
+                'rows': sum(s['rows'] for s in sites.values()),
+                'seconds': sum(s['seconds'] for s in sites.values()),
+                'sites': sites,
+                'statements': dict(self._statements),
+                'slow_queries': list(self._slow),
+            }
+
+    def summary(self):
+        return format_summary(self.snapshot())
+
+
+def format_summary(snap):
+    """
+    A few lines of text summarising a stats snapshot (see Bear.stats()),
+    busiest call site first.
+    """
+    lines = ['{} queries, {} rows, {:.3f}s in the database'.format(
+        snap['queries'], snap['rows'], snap['seconds'])]
+    for site, s in sorted(snap['sites'].items(),
+                          key = lambda i: -i[1]['seconds']):
+        lines.append('  {:32} {:7} queries {:9} rows {:9.3f}s '
+                     '(max {:.3f}s)'.format(site, s['queries'], s['rows'],
+                                             s['seconds'], s['max_seconds']))
+    if snap['slow_queries']:
+        lines.append('  {} slow queries, the slowest took {:.3f}s'.format(
+            len(snap['slow_queries']),
+            max(q['seconds'] for q in snap['slow_queries'])))
+    return '\n'.join(lines)
+
+
+class TimedCursor(object):
+    """
+    Wraps a cursor, timing each query from execute() until its results have
+    all been fetched, and counting the rows. Only the methods pybear uses are
+    here.
+    """
+    def __init__(self, cursor, site, stats):
+        self._cursor = cursor
+        self._site = site
+        self._stats = stats
+        self._sql = None
+        self._seconds = 0.0
+        self._rows = 0
+
+    def _finish(self):
+        if self._sql is not None:
+            self._stats.record(self._site, self._sql, self._seconds, self._rows)
+            self._sql = None
+
+    def _timed(self, fn, *args):
+        start = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            self._seconds += time.perf_counter() - start
+
+    def execute(self, sql, params = ()):
+        self._finish()
+        self._sql = sql
+        self._seconds = 0.0
+        self._rows = 0
+        self._timed(self._cursor.execute, sql, params)
+        return self
+
+    def fetchone(self):
+        row = self._timed(self._cursor.fetchone)
+        self._rows += row is not None
+        self._finish()
+        return row
+
+    def fetchmany(self, size):
+        rows = self._timed(self._cursor.fetchmany, size)
+        self._rows += len(rows)
+        if len(rows) < size:
+            self._finish()
+        return rows
+
+    def fetchall(self):
+        rows = self._timed(self._cursor.fetchall)
+        self._rows += len(rows)
+        self._finish()
+        return rows
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+    def __del__(self):
+        # A query that was abandoned part way through still counts
+        try:
+            self._finish()
+        except Exception:
+            pass
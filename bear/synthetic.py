@@ -0,0 +1,265 @@
+#
+# Copyright (c) 2020  Richard Clark
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+"""
+Builds a fake Bear database, for benchmarking and playing with pybear on a
+machine without Bear on it. The tables look like the real ones (same columns,
+same Core Data conventions), the contents are random but repeatable for a
+given seed.
+
+    python -m bear.synthetic --notes 30000 /tmp/fakebear/database.sqlite
+"""
+import argparse
+import os
+import os.path
+import random
+import sqlite3
+import sys
+import uuid
+
+
+SCHEMA = '''
+    CREATE TABLE ZSFNOTE (
+        Z_PK                INTEGER PRIMARY KEY,
+        Z_ENT               INTEGER,
+        Z_OPT               INTEGER,
+        ZARCHIVED           INTEGER,
+        ZENCRYPTED          INTEGER,
+        ZHASSOURCECODE      INTEGER,
+        ZLOCKED             INTEGER,
+        ZORDER              INTEGER,
+        ZPERMANENTLYDELETED INTEGER,
+        ZPINNED             INTEGER,
+        ZSHOWNINTODAYWIDGET INTEGER,
+        ZSKIPSYNC           INTEGER,
+        ZTODOCOMPLETED      INTEGER,
+        ZTODOINCOMPLETED    INTEGER,
+        ZTRASHED            INTEGER,
+        ZFOLDER             INTEGER,
+        ZARCHIVEDDATE       TIMESTAMP,
+        ZCREATIONDATE       TIMESTAMP,
+        ZLOCKEDDATE         TIMESTAMP,
+        ZMODIFICATIONDATE   TIMESTAMP,
+        ZORDERDATE          TIMESTAMP,
+        ZPINNEDDATE         TIMESTAMP,
+        ZTRASHEDDATE        TIMESTAMP,
+        ZLASTEDITINGDEVICE  VARCHAR,
+        ZTEXT               VARCHAR,
+        ZTITLE              VARCHAR,
+        ZUNIQUEIDENTIFIER   VARCHAR,
+        ZVECTORCLOCK        BLOB
+    );
+    CREATE TABLE ZSFNOTETAG (
+        Z_PK                INTEGER PRIMARY KEY,
+        Z_ENT               INTEGER,
+        Z_OPT               INTEGER,
+        ZMODIFICATIONDATE   TIMESTAMP,
+        ZTITLE              VARCHAR
+    );
+    CREATE TABLE Z_7TAGS (
+        Z_7NOTES            INTEGER,
+        Z_14TAGS            INTEGER,
+        PRIMARY KEY (Z_7NOTES, Z_14TAGS)
+    );
+    CREATE INDEX Z_7TAGS_Z_14TAGS_INDEX ON Z_7TAGS (Z_14TAGS, Z_7NOTES);
+    CREATE INDEX ZSFNOTE_ZFOLDER_INDEX ON ZSFNOTE (ZFOLDER);
+'''
+
+WORDS = '''
+    the of and to in is that it for on with as was at by be this from or
+    an have not are but had they you which one all were we there can been
+    note bear idea project meeting garden recipe book travel code draft
+    list plan review week month budget design research paper question
+    answer follow up later today important maybe someday call email read
+'''.split()
+
+# A tiny valid PNG, padded out to the requested size
+PNG_HEADER = bytes.fromhex(
+    '89504e470d0a1a0a0000000d49484452000000010000000108060000001f15c489'
+    '0000000d49444154789c6360000002000100e221bc330000000049454e44ae426082')
+
+# Core Data timestamps (seconds since 2001) for 2015 and 2020
+START_DATE = 441763200.0
+END_DATE = 599616000.0
+
+
+def make_tags(rng, roots, fanout, depth):
+    """
+    Titles of a tag hierarchy: `roots` top level tags, each with `fanout`
+    children, down to `depth` levels.
+    """
+    tags = []
+    level = ['{}{}'.format(rng.choice(WORDS), i) for i in range(roots)]
+    for d in range(depth):
+        tags.extend(level)
+        level = ['{}/{}{}'.format(parent, rng.choice(WORDS), i)
+                 for parent in level for i in range(fanout)]
+    return tags
+
+
+def make_text(rng, title, length, tags, images, links):
+    lines = ['# ' + title, '']
+    size = 0
+    while size < length:
+        kind = rng.random()
+        if kind < 0.1:
+            line = '## ' + ' '.join(rng.choice(WORDS) for _ in range(3))
+        elif kind < 0.25:
+            line = '- [{}] {}'.format(rng.choice(' x'),
+                ' '.join(rng.choice(WORDS) for _ in range(5)))
+        elif kind < 0.3 and links:
+            line = 'See [[{}]]'.format(rng.choice(links))
+        else:
+            line = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(5, 25)))
+        lines.append(line)
+        size += len(line) + 1
+    for image in images:
+        lines.append('[image:{}]'.format(image))
+    if tags:
+        lines.append(' '.join('#' + t for t in tags))
+    return '\n'.join(lines)
+
+
+def generate(path, notes = 1000, text_length = 2000, tag_roots = 10,
+        tag_fanout = 3, tag_depth = 3, tags_per_note = 2, images_per_note = 0.2,
+        image_size = 20000, trashed = 0.02, deleted = 0.01, archived = 0.05,
+        pinned = 0.01, seed = 0):
+    """
+    Write a database at path (replacing any that's there), plus the images
+    under "Local Files/Note Images" next to it, as Bear lays them out.
+
+    images_per_note may be fractional; it's the average.
+    """
+    rng = random.Random(seed)
+    base = os.path.dirname(os.path.abspath(path))
+    images_dir = os.path.join(base, 'Local Files', 'Note Images')
+    os.makedirs(images_dir, exist_ok = True)
+    if os.path.exists(path):
+        os.remove(path)
+
+    db = sqlite3.connect(path)
+    db.executescript(SCHEMA)
+
+    tags = make_tags(rng, tag_roots, tag_fanout, tag_depth)
+    tag_ids = {}
+    for i, title in enumerate(tags, 1):
+        tag_ids[title] = i
+        db.execute('INSERT INTO ZSFNOTETAG VALUES (?, 14, 1, ?, ?)',
+                   [i, END_DATE, title])
+
+    titles = ['{} {}'.format(' '.join(rng.choice(WORDS) for _ in range(3)),
+                             i).capitalize() for i in range(notes)]
+
+    for pk in range(1, notes + 1):
+        title = titles[pk - 1]
+        note_tags = rng.sample(tags, min(tags_per_note, len(tags)))
+
+        image_count = int(images_per_note)
+        if rng.random() < images_per_note - image_count:
+            image_count += 1
+        images = []
+        for i in range(image_count):
+            name = '{}/image{}.png'.format(
+                str(uuid.UUID(int = rng.getrandbits(128))).upper(), i)
+            images.append(name)
+            image_path = os.path.join(images_dir, name)
+            os.makedirs(os.path.dirname(image_path), exist_ok = True)
+            with open(image_path, 'wb') as f:
+                f.write(PNG_HEADER + b'\0' * max(0, image_size - len(PNG_HEADER)))
+
+        text = make_text(rng, title,
+            int(rng.expovariate(1 / text_length)) if text_length else 0,
+            note_tags, images, titles[max(0, pk - 50):pk + 50])
+
+        created = rng.uniform(START_DATE, END_DATE)
+        modified = rng.uniform(created, END_DATE)
+        is_trashed = rng.random() < trashed
+        is_deleted = rng.random() < deleted
+        is_archived = rng.random() < archived
+        is_pinned = rng.random() < pinned
+
+        db.execute('''
+            INSERT INTO ZSFNOTE (Z_PK, Z_ENT, Z_OPT, ZARCHIVED, ZENCRYPTED,
+                ZHASSOURCECODE, ZLOCKED, ZORDER, ZPERMANENTLYDELETED, ZPINNED,
+                ZSHOWNINTODAYWIDGET, ZSKIPSYNC, ZTODOCOMPLETED,
+                ZTODOINCOMPLETED, ZTRASHED, ZFOLDER, ZARCHIVEDDATE,
+                ZCREATIONDATE, ZLOCKEDDATE, ZMODIFICATIONDATE, ZORDERDATE,
+                ZPINNEDDATE, ZTRASHEDDATE, ZLASTEDITINGDEVICE, ZTEXT, ZTITLE,
+                ZUNIQUEIDENTIFIER, ZVECTORCLOCK)
+            VALUES (?, 7, 1, ?, 0, 0, 0, 0, ?, ?, 0, 0, ?, ?, ?, NULL, ?, ?,
+                NULL, ?, ?, ?, ?, 'pybear', ?, ?, ?, ?)
+        ''', [
+            pk, int(is_archived), int(is_deleted), int(is_pinned),
+            text.count('- [x]'), text.count('- [ ]'), int(is_trashed),
+            modified if is_archived else None, created, modified, modified,
+            modified if is_pinned else None, modified if is_trashed else None,
+            text, title, str(uuid.UUID(int = rng.getrandbits(128))).upper(),
+            bytes(rng.getrandbits(8) for _ in range(64)),
+        ])
+
+        # Like Bear, a note with #a/b/c is linked to #a/b and #a as well
+        linked = set()
+        for title in note_tags:
+            parts = title.split('/')
+            for i in range(1, len(parts) + 1):
+                linked.add(tag_ids['/'.join(parts[:i])])
+        db.executemany('INSERT INTO Z_7TAGS VALUES (?, ?)',
+                       [(pk, t) for t in sorted(linked)])
+
+    db.commit()
+    db.close()
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Generate a synthetic Bear database')
+    parser.add_argument('output', type = str,
+                        help = 'path of the database.sqlite to write')
+    parser.add_argument('--notes', type = int, default = 1000)
+    parser.add_argument('--text-length', type = int, default = 2000,
+                        help = 'average note length in characters')
+    parser.add_argument('--tag-roots', type = int, default = 10)
+    parser.add_argument('--tag-fanout', type = int, default = 3)
+    parser.add_argument('--tag-depth', type = int, default = 3)
+    parser.add_argument('--tags-per-note', type = int, default = 2)
+    parser.add_argument('--images-per-note', type = float, default = 0.2)
+    parser.add_argument('--image-size', type = int, default = 20000,
+                        help = 'size of each image in bytes')
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--force', action = "store_true",
+                        help = 'replace the database if it already exists')
+    args = parser.parse_args()
+
+    # This could be pointed at your real Bear database by mistake
+    if os.path.exists(args.output) and not args.force:
+        print("{} already exists, use --force to replace it".format(args.output))
+        sys.exit(1)
+
+    generate(args.output, notes = args.notes, text_length = args.text_length,
+        tag_roots = args.tag_roots, tag_fanout = args.tag_fanout,
+        tag_depth = args.tag_depth, tags_per_note = args.tags_per_note,
+        images_per_note = args.images_per_note, image_size = args.image_size,
+        seed = args.seed)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+#
+# Copyright (c) 2020  Richard Clark
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+"""
+An in-memory index of the tag hierarchy. Bear tags nest with '/', so
+'#area/project/sub' lives under '#area/project' which lives under '#area'.
+Working this out by comparing title prefixes gets slow (and wrong - 'ab' is
+not a child of 'a') so we build the tree once and answer questions from it.
+"""
+
+
+class TagTree(object):
+    """
+    Built from a list of Tag objects, normally via Bear.tag_tree() which
+    caches it on the Bear instance.
+
+    All lookups take either a Tag or a tag title.
+    """
+    def __init__(self, tags):
+        self._by_id = {}
+        self._by_title = {}
+        for tag in tags:
+            self._by_id[tag.id] = tag
+            self._by_title[tag.title] = tag
+
+        # Each tag's nearest existing parent and direct children. A parent
+        # tag may be missing from the table (e.g. part way through a sync), in
+        # which case we hang the tag off the closest ancestor we do have.
+        self._parent = {}
+        self._children = {}
+        # Ids of all the ancestors of each tag, for constant time "is X
+        # below Y" checks.
+        self._ancestors = {}
+        for tag in self._by_id.values():
+            ancestors = []
+            parts = tag.title.split('/')
+            for i in range(len(parts) - 1, 0, -1):
+                parent = self._by_title.get('/'.join(parts[:i]))
+                if parent is not None:
+                    ancestors.append(parent.id)
+            self._ancestors[tag.id] = frozenset(ancestors)
+            self._parent[tag.id] = ancestors[0] if ancestors else None
+            if ancestors:
+                self._children.setdefault(ancestors[0], []).append(tag.id)
+
+    def _tag(self, tag):
+        if isinstance(tag, str):
+            return self._by_title.get(tag)
+        return self._by_id.get(tag.id)
+
+    def __len__(self):
+        return len(self._by_id)
+
+    def __contains__(self, tag):
+        return self._tag(tag) is not None
+
+    def get(self, title):
+        return self._by_title.get(title)
+
+    def roots(self):
+        return [t for t in self._by_id.values()
+                if self._parent[t.id] is None]
+
+    def parent(self, tag):
+        tag = self._tag(tag)
+        if tag is None or self._parent[tag.id] is None:
+            return None
+        return self._by_id[self._parent[tag.id]]
+
+    def ancestors(self, tag):
+        """
+        Ancestors of the tag, closest first.
+        """
+        result = []
+        tag = self.parent(tag)
+        while tag is not None:
+            result.append(tag)
+            tag = self.parent(tag)
+        return result
+
+    def children(self, tag):
+        tag = self._tag(tag)
+        if tag is None:
+            return []
+        return [self._by_id[i] for i in self._children.get(tag.id, [])]
+
+    def descendants(self, tag):
+        result = []
+        stack = self.children(tag)
+        while stack:
+            t = stack.pop()
+            result.append(t)
+            stack.extend(self.children(t))
+        return result
+
+    def is_ancestor(self, ancestor, tag):
+        """
+        Is `ancestor` strictly above `tag` in the hierarchy?
+        """
+        ancestor = self._tag(ancestor)
+        tag = self._tag(tag)
+        if ancestor is None or tag is None:
+            return False
+        return ancestor.id in self._ancestors[tag.id]
+
+    def has_more_specific(self, tag, tags):
+        """
+        Does the given collection of tags (usually Note.tags()) include
+        anything below `tag`?
+        """
+        tag = self._tag(tag)
+        if tag is None:
+            return False
+        for t in tags:
+            if tag.id in self._ancestors.get(t.id, ()):
+                return True
+        return False
+
+    def specific_tags(self, tags):
+        """
+        Drop the tags that have a more specific tag in the same collection,
+        e.g. ['a', 'a/b', 'a/b/c', 'x'] becomes ['a/b/c', 'x'].
+        """
+        tags = list(tags)
+        covered = set()
+        for t in tags:
+            covered.update(self._ancestors.get(t.id, ()))
+        return [t for t in tags if t.id not in covered]
+
+    def specific_tags_for_notes(self, tag_map):
+        """
+        specific_tags() for many notes at once. Takes a dict of note to tags,
+        as returned by Bear._note_tag_map(), and returns a dict of the same
+        keys.
+        """
+        return {k: self.specific_tags(v) for k, v in tag_map.items()}
@@ -0,0 +1,177 @@
+#
+# Copyright (c) 2020  Richard Clark
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+
+"""
+Watching the database for changes. Rather than re-reading every note on a
+timer, we check cheaply whether anything has been written at all (SQLite's
+data_version, and the database and WAL file mtimes) and only then ask for
+the notes modified or trashed since the last look.
+"""
+import os.path
+import time
+
+from .pool import open_connection
+
+
+CREATED = 'created'
+MODIFIED = 'modified'
+TRASHED = 'trashed'
+DELETED = 'deleted'
+
+
+class ChangeEvent(object):
+    """
+    type is one of CREATED, MODIFIED, TRASHED or DELETED. note is the Note as
+    it is now, or None for notes that have gone from the database entirely
+    (then only id and int_id are known).
+    """
+    def __init__(self, type, id, int_id, note = None):
+        self.type = type
+        self.id = id
+        self.int_id = int_id
+        self.note = note
+
+    def __str__(self):
+        return "{} ({}) {}".format(self.type, self.id,
+            self.note.title if self.note else '')
+
+
+class ChangeFeed(object):
+    """
+    Tracks the notes in the database and reports what changed since the last
+    call to poll(). Changes from before the feed was created aren't reported,
+    unless since (a Core Data timestamp, like ZMODIFICATIONDATE) is given, in
+    which case notes modified after it are.
+
+    The feed keeps its own read only connection, as data_version is only
+    meaningful when asked of the same connection each time.
+    """
+    def __init__(self, bear, since = None):
+        self._bear = bear
+        self._db = open_connection(bear._path, read_only = True,
+            check_same_thread = False)
+        self._data_version = None
+        self._mtimes = None
+        self._changed()
+
+        cursor = self._db.execute('''
+            SELECT Z_PK, ZUNIQUEIDENTIFIER, ZTRASHED, ZPERMANENTLYDELETED,
+                ZMODIFICATIONDATE, ZTRASHEDDATE FROM ZSFNOTE
+        ''')
+        # Z_PK -> (ZUNIQUEIDENTIFIER, state)
+        self._known = {}
+        self._high_water = 0
+        for row in cursor.fetchall():
+            self._known[row['Z_PK']] = (row['ZUNIQUEIDENTIFIER'], _state(row))
+            self._high_water = max(self._high_water,
+                row['ZMODIFICATIONDATE'] or 0, row['ZTRASHEDDATE'] or 0)
+
+        if since is not None:
+            # Forget what we know about the notes changed since then, so they
+            # get reported as created on the first poll().
+            for pk in [pk for pk, in self._db.execute(
+                    'SELECT Z_PK FROM ZSFNOTE WHERE ZMODIFICATIONDATE > ?',
+                    [since])]:
+                del self._known[pk]
+            self._high_water = since
+
+    def close(self):
+        self._db.close()
+
+    def _changed(self):
+        """
+        Has anything written to the database since we last checked?
+        """
+        data_version = self._db.execute('PRAGMA data_version').fetchone()[0]
+        mtimes = []
+        for suffix in ('', '-wal'):
+            try:
+                mtimes.append(os.path.getmtime(self._bear._path + suffix))
+            except OSError:
+                mtimes.append(None)
+
+        changed = data_version != self._data_version or mtimes != self._mtimes
+        self._data_version = data_version
+        self._mtimes = mtimes
+        return changed
+
+    def poll(self, force = False):
+        """
+        Return a list of ChangeEvents since the last poll, possibly empty.
+        """
+        if not self._changed() and not force:
+            return []
+
+        cursor = self._db.execute('''
+            SELECT * FROM ZSFNOTE
+            WHERE ZMODIFICATIONDATE > ? OR ZTRASHEDDATE > ?
+        ''', [self._high_water, self._high_water])
+
+        events = []
+        for row in cursor.fetchall():
+            pk = row['Z_PK']
+            self._high_water = max(self._high_water,
+                row['ZMODIFICATIONDATE'] or 0, row['ZTRASHEDDATE'] or 0)
+
+            state = _state(row)
+            old = self._known.get(pk)
+            self._known[pk] = (row['ZUNIQUEIDENTIFIER'], state)
+            if old is None and state == MODIFIED:
+                type = CREATED
+            elif old is not None and old[1] == state and state != MODIFIED:
+                # Still in the trash (or deleted) - nothing new to report
+                continue
+            else:
+                type = state
+            events.append(ChangeEvent(type, row['ZUNIQUEIDENTIFIER'], pk,
+                self._bear._row_to_note(row)))
+
+        # Notes that have gone from the table altogether. Only the primary
+        # keys are read, so this stays cheap.
+        present = {pk for pk, in self._db.execute('SELECT Z_PK FROM ZSFNOTE')}
+        for pk in [pk for pk in self._known if pk not in present]:
+            id, state = self._known.pop(pk)
+            if state != DELETED:
+                events.append(ChangeEvent(DELETED, id, pk))
+
+        if events:
+            self._bear._invalidate()
+        return events
+
+    def wait(self, interval = 1.0):
+        """
+        Block until there are changes, checking every interval seconds, and
+        return them.
+        """
+        while True:
+            events = self.poll()
+            if events:
+                return events
+            time.sleep(interval)
+
+
+def _state(row):
+    if row['ZPERMANENTLYDELETED']:
+        return DELETED
+    if row['ZTRASHED']:
+        return TRASHED
+    return MODIFIED
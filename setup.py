@@ -21,6 +21,10 @@ setuptools.setup(
     install_requires=[
         'Markdown',
     ],
+    extras_require={
+        'numpy': ['numpy'],
+        'zstd': ['zstandard'],
+    },
 
     packages=setuptools.find_packages(),
     entry_points={